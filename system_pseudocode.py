@@ -4,7 +4,7 @@ Output: list of menu items
 
 BEGIN
   IF user_id is NULL THEN
-    FETCH all menu items WHERE is_available = TRUE AND is_vip_only = FALSE
+    GET menu snapshot with is_vip = FALSE
     RETURN menu items
   END IF
 
@@ -14,17 +14,158 @@ BEGIN
   END IF
 
   IF user is VIP THEN
-    FETCH all menu items WHERE is_available = TRUE
+    GET menu snapshot with is_vip = TRUE
   ELSE
-    FETCH all menu items WHERE is_available = TRUE AND is_vip_only = FALSE
+    GET menu snapshot with is_vip = FALSE
   END IF
 
-  GET recommendations for user
+  GET stored recommendations for user's customer_id
+  IF stored recommendations not found THEN
+    GET recommendations for user
+  ELSE
+    FILTER stored recommendations to items present in the menu items above
+  END IF
   MERGE menu items with recommendations
   RETURN merged result
 END
 
 
+Function: build_menu_snapshot
+Input: none
+Output: none
+
+BEGIN
+  // Writers (this and apply_menu_item_to_snapshot) serialise on the snapshot lock;
+  // readers never take it and always see either the old or the new views
+  ACQUIRE snapshot lock
+  IF this process is not subscribed to menu item invalidations THEN
+    // Before the fetch: an invalidation published meanwhile waits for the lock and is applied after the swap
+    SUBSCRIBE to published menu item invalidations, applying each with apply_menu_item_to_snapshot
+  END IF
+  FETCH all menu items WHERE is_available = TRUE
+
+  CREATE empty public view keyed by item_id
+  CREATE empty VIP view keyed by item_id
+  FOR EACH item IN menu items DO
+    ADD item to VIP view
+    IF item is not VIP only THEN
+      ADD item to public view
+    END IF
+  END FOR
+
+  BUILD menu index for public view
+  BUILD menu index for VIP view
+
+  // Swap both views in one step so readers never see a half-built snapshot
+  REPLACE snapshot public_view = public view
+  REPLACE snapshot vip_view = VIP view
+  INCREMENT snapshot version by 1
+  SET snapshot built_at = current timestamp
+  RELEASE snapshot lock
+END
+
+
+Function: get_menu_snapshot
+Input: is_vip (boolean)
+Output: list of menu items
+
+BEGIN
+  IF snapshot has not been built THEN
+    INCREMENT snapshot miss_count by 1
+    BUILD menu snapshot
+  ELSE
+    INCREMENT snapshot hit_count by 1
+  END IF
+
+  IF is_vip THEN
+    RETURN items in snapshot vip_view
+  END IF
+
+  RETURN items in snapshot public_view
+END
+
+
+Function: refresh_menu_snapshot_item
+Input: item_id (integer)
+Output: none
+
+BEGIN
+  APPLY menu item change to snapshot for item_id
+  // Every process holds its own snapshot, so the others must hear about the change
+  PUBLISH menu item invalidation for item_id to the other application processes
+END
+
+
+Function: apply_menu_item_to_snapshot
+Input: item_id (integer)
+Output: none
+
+BEGIN
+  // Used for local changes and for invalidations published by other processes
+  ACQUIRE snapshot lock
+  IF snapshot has not been built THEN
+    RELEASE snapshot lock
+    RETURN                                     // the first build reads the item from the database
+  END IF
+
+  // Copy-on-write: change copies of the views and indexes, then swap them in, so
+  // search_menu and get_top_rated_items never see the item missing or an index half-updated.
+  // Menus are small, so copying per change is cheap
+  SET public view = copy of snapshot public_view and its menu index
+  SET VIP view = copy of snapshot vip_view and its menu index
+  REMOVE item_id from public view and its menu index
+  REMOVE item_id from VIP view and its menu index
+
+  FETCH menu item by item_id                   // under the lock, so a later invalidation cannot be overtaken
+  IF menu item found AND menu item is available THEN
+    ADD menu item to VIP view and its menu index
+    IF menu item is not VIP only THEN
+      ADD menu item to public view and its menu index
+    END IF
+  END IF
+
+  REPLACE snapshot public_view = public view
+  REPLACE snapshot vip_view = VIP view
+  INCREMENT snapshot version by 1
+  INCREMENT snapshot invalidation_count by 1
+  RELEASE snapshot lock
+END
+
+
+Function: update_menu_item
+Input: item_id (integer), price (decimal), is_available (boolean), is_vip_only (boolean)
+Output: none
+
+BEGIN
+  FETCH menu item by item_id
+  IF menu item not found THEN
+    THROW error "Not found"
+  END IF
+
+  SET changed = (menu item price does not equal price
+                 OR menu item is_available does not equal is_available
+                 OR menu item is_vip_only does not equal is_vip_only)
+
+  SET menu item price = price
+  SET menu item is_available = is_available
+  SET menu item is_vip_only = is_vip_only
+  SAVE menu item to database
+
+  IF changed THEN
+    REFRESH menu snapshot for item_id
+  END IF
+END
+
+
+Function: get_menu_snapshot_stats
+Input: none
+Output: version (integer), hit_count (integer), miss_count (integer), invalidation_count (integer)
+
+BEGIN
+  RETURN snapshot version, snapshot hit_count, snapshot miss_count, snapshot invalidation_count
+END
+
+
 Function: filter_menu
 Input: menu_items (list), chef_id (integer or NULL), min_price (decimal), max_price (decimal), min_rating (decimal)
 Output: filtered list of menu items
@@ -53,127 +194,1273 @@ END
 
 
 
+Function: build_menu_index
+Input: menu_items (list)
+Output: menu index
+
+BEGIN
+  CREATE new menu index
+  SET index items = empty map of item_id to item
+  SET index price_keys = empty sorted list of (price, item_id)
+  SET index rating_keys = empty sorted list of (average rating, item_id)
+  SET index chef_buckets = empty map of chef_id to set of item_id
+
+  FOR EACH item IN menu_items DO
+    ADD item to menu index
+  END FOR
+
+  RETURN menu index
+END
+
+
+Function: menu_index_add_item
+Input: index (menu index), item (menu item)
+Output: none
+
+BEGIN
+  IF item's item_id is in index items THEN
+    REMOVE item's item_id from menu index
+  END IF
+
+  SET index items[item_id] = item
+  INSERT (item price, item_id) into index price_keys keeping sort order (bisection)
+  INSERT (item average rating, item_id) into index rating_keys keeping sort order (bisection)
+  ADD item_id to index chef_buckets[item's chef_id]
+END
+
+
+Function: menu_index_remove_item
+Input: index (menu index), item_id (integer)
+Output: none
+
+BEGIN
+  IF item_id not in index items THEN
+    RETURN
+  END IF
+
+  SET item = index items[item_id]
+  DELETE (item price, item_id) from index price_keys (located by bisection)
+  DELETE (item average rating, item_id) from index rating_keys (located by bisection)
+  REMOVE item_id from index chef_buckets[item's chef_id]
+  IF index chef_buckets[item's chef_id] is empty THEN
+    DELETE index chef_buckets[item's chef_id]
+  END IF
+  DELETE index items[item_id]
+END
+
+
+Function: search_menu
+Input: is_vip (boolean), chef_id (integer or NULL), min_price (decimal), max_price (decimal), min_rating (decimal), sort_by (string), page (integer), page_size (integer)
+Output: page of menu items (list), total_count (integer)
+
+BEGIN
+  // Same matching rules as filter_menu, answered from the snapshot's index
+  IF snapshot has not been built THEN
+    BUILD menu snapshot
+  END IF
+
+  IF is_vip THEN
+    SET index = menu index of snapshot vip_view
+  ELSE
+    SET index = menu index of snapshot public_view
+  END IF
+
+  BISECT index price_keys for first key >= (min_price) and last key <= (max_price)
+  SET price_range = price_keys between those two positions
+  BISECT index rating_keys for first key >= (min_rating)
+  SET rating_range = rating_keys from that position to the end
+
+  SET candidate sets = [price_range, rating_range]
+  IF chef_id is not NULL THEN
+    IF chef_id not in index chef_buckets THEN
+      RETURN empty list, 0
+    END IF
+    ADD index chef_buckets[chef_id] to candidate sets
+  END IF
+
+  // Walk the smallest candidate set and probe the other criteria per item,
+  // which intersects the sets without materialising the larger ones
+  SET driver = candidate set with the fewest entries
+  CREATE empty result list
+  FOR EACH item_id IN driver DO
+    SET item = index items[item_id]
+    IF chef_id is not NULL AND item's chef_id does not equal chef_id THEN
+      SKIP to next item
+    END IF
+    IF item price < min_price OR item price > max_price THEN
+      SKIP to next item
+    END IF
+    IF item average rating < min_rating THEN
+      SKIP to next item
+    END IF
+    ADD item to result list
+  END FOR
+
+  IF sort_by equals "PRICE_ASC" THEN
+    SORT result list by price ascending
+  ELSE IF sort_by equals "PRICE_DESC" THEN
+    SORT result list by price descending
+  ELSE IF sort_by equals "RATING" THEN
+    SORT result list by average rating descending
+  END IF
+
+  SET total_count = size of result list
+  SET start = (page - 1) × page_size
+  RETURN result list from start to (start + page_size), total_count
+END
+
+
+
+Function: get_top_rated_items
+Input: is_vip (boolean), k (integer)
+Output: list of menu items
+
+BEGIN
+  IF snapshot has not been built THEN
+    BUILD menu snapshot
+  END IF
+
+  IF is_vip THEN
+    SET index = menu index of snapshot vip_view
+  ELSE
+    SET index = menu index of snapshot public_view
+  END IF
+
+  // rating_keys is kept sorted, so the leaderboard is its last k entries
+  CREATE empty result list
+  FOR EACH (rating, item_id) IN the last k entries of index rating_keys, highest first DO
+    ADD index items[item_id] to result list
+  END FOR
+
+  RETURN result list
+END
+
+
+
 Function: get_recommendations_for_user
 Input: user (user object)
 Output: list of recommended menu items
 
 BEGIN
-  FETCH all past orders for user's customer_id
+  FETCH top 5 item frequency rows for user's customer_id ordered by quantity descending
 
-  IF no past orders exist THEN
-    FETCH top 5 highest-rated menu items
+  IF no frequency rows exist THEN
+    GET top 5 rated items with is_vip = user is VIP
     RETURN top rated items
   END IF
 
-  CREATE empty frequency map
+  SET top items = item_ids of the fetched frequency rows
+  SET top weights = quantities of the fetched frequency rows
+  EXPAND top items with similar items using top weights
+  FILTER results by availability and VIP status
+  RETURN filtered recommendations
+END
+
 
-  FOR EACH order IN past orders DO
-    FETCH all order items for this order
-    FOR EACH order_item IN order items DO
-      IF item_id not in frequency map THEN
-        SET frequency[item_id] = 0
+
+Function: update_item_frequency_profile
+Input: customer_id (integer), order_items (list)
+Output: none
+
+BEGIN
+  // Called inside the place_order transaction so the profile never drifts from order_items
+  ACQUIRE transaction-scoped lock on item frequency profile of customer_id   // shared with the rebuild
+  FOR EACH order_item IN order_items DO
+    UPSERT item frequency row (customer_id, order_item's item_id):
+      IF row does not exist THEN
+        SET quantity = order_item quantity
+      ELSE
+        INCREMENT quantity by order_item quantity
       END IF
-      INCREMENT frequency[item_id] by order_item quantity
-    END FOR
+      SET updated_at = current timestamp
   END FOR
+END
 
-  GET top 5 items by frequency count
-  EXPAND top items to include similar items
-  FILTER results by availability and VIP status
-  RETURN filtered recommendations
+
+Function: compute_item_frequencies_from_history
+Input: customer_id (integer)
+Output: frequency map (item_id to quantity)
+
+BEGIN
+  CREATE empty frequency map
+
+  FETCH all order items JOIN orders WHERE orders customer_id = customer_id
+  FOR EACH order_item IN order items DO
+    IF item_id not in frequency map THEN
+      SET frequency[item_id] = 0
+    END IF
+    INCREMENT frequency[item_id] by order_item quantity
+  END FOR
+
+  RETURN frequency map
+END
+
+
+Function: rebuild_item_frequency_profiles
+Input: customer_id (integer or NULL)
+Output: rebuilt_count (integer)
+
+BEGIN
+  IF customer_id is NULL THEN
+    FETCH all customer ids that have at least one order
+  ELSE
+    SET customer ids = [customer_id]
+  END IF
+
+  SET rebuilt_count = 0
+  FOR EACH id IN customer ids DO
+    BEGIN database transaction (READ COMMITTED)
+    // Taken before reading history: an in-flight place_order commits first and is seen
+    // by the recompute, and later orders wait until the new rows are in place
+    ACQUIRE transaction-scoped lock on item frequency profile of id
+    COMPUTE item frequencies from history for id
+    DELETE all item frequency rows for id
+    INSERT one item frequency row per entry in frequency map
+    COMMIT database transaction
+
+    INCREMENT rebuilt_count by 1
+  END FOR
+
+  RETURN rebuilt_count
+END
+
+
+Function: check_item_frequency_profile
+Input: customer_id (integer)
+Output: consistent (boolean), mismatches (list of item_id, stored quantity, expected quantity)
+
+BEGIN
+  // Both reads come from one snapshot, so a concurrent place_order is either in both or in neither
+  BEGIN read-only database transaction (REPEATABLE READ)
+  FETCH all item frequency rows for customer_id
+  COMPUTE item frequencies from history for customer_id
+  COMMIT database transaction
+
+  CREATE empty mismatches list
+  FOR EACH item_id IN union of stored item_ids and frequency map keys DO
+    SET stored = stored quantity for item_id, or 0 if missing
+    SET expected = frequency[item_id], or 0 if missing
+    IF stored does not equal expected THEN
+      ADD (item_id, stored, expected) to mismatches
+    END IF
+  END FOR
+
+  RETURN (mismatches is empty), mismatches
+END
+
+
+
+Function: build_item_similarity_model
+Input: none
+Output: model_version (integer)
+
+BEGIN
+  STREAM all order items as (order_id, item_id), ordered by order_id
+  ASSIGN each distinct item_id a column index, kept in a sorted item_ids array (int64)
+
+  // Sparse order-by-item incidence matrix; an item counts once per order
+  BUILD sparse CSR matrix A with one row per order and one column per item, A[order, item] = 1
+  SET C = A transposed × A                           // sparse item-item co-occurrence counts
+  SET n = diagonal of C                              // number of orders containing each item
+  SET C diagonal = 0
+  SET S = C scaled so S[i, j] = C[i, j] / sqrt(n[i] × n[j])   // cosine similarity
+
+  FOR EACH row i IN S DO
+    KEEP only the SIMILAR_NEIGHBOURS_PER_ITEM largest entries (argpartition)
+  END FOR
+
+  WRITE model files to a new versioned directory:
+    item_ids.npy   (int64, sorted)
+    offsets.npy    (int64, row start of each item in neighbours/scores, CSR layout)
+    neighbours.npy (int32, column index of each neighbour)
+    scores.npy     (float32, similarity of each neighbour)
+  RENAME versioned directory into place and point "current" at it  // atomic switch
+  RETURN new model_version
+END
+
+
+Function: load_item_similarity_model
+Input: none
+Output: none
+
+BEGIN
+  // Memory-map so every worker shares the same pages and startup does not copy the model
+  SET directory = resolved "current" model directory
+  CREATE new similarity model
+  SET new model item_ids = memory-map item_ids.npy from directory
+  SET new model offsets = memory-map offsets.npy from directory
+  SET new model neighbours = memory-map neighbours.npy from directory
+  SET new model scores = memory-map scores.npy from directory
+
+  // One reference swap, so an expansion never mixes arrays from two builds
+  REPLACE current similarity model with new model
+END
+
+
+Function: expand_similar_items
+Input: top_items (list of item_id), top_weights (list of decimal), limit (integer)
+Output: list of item_id
+
+BEGIN
+  SET model = current similarity model      // read once; a concurrent reload does not affect this call
+  SET rows = searchsorted(model item_ids, top_items)
+  DROP rows (and their weights) whose item_id is not in model item_ids
+  IF no rows remain THEN
+    RETURN top_items
+  END IF
+
+  SET starts = model offsets[rows]
+  SET lengths = model offsets[rows + 1] - starts
+  SET positions = concatenated ranges starts to starts + lengths
+  SET candidates = model neighbours[positions]
+  SET weighted = model scores[positions] × repeat(top_weights, lengths)
+
+  // Sum scores per candidate with one pass: unique + bincount
+  SET unique_candidates, inverse = unique(candidates, return_inverse)
+  SET totals = bincount(inverse, weights = weighted)
+  SET totals[unique_candidates found in rows] = -infinity      // do not re-suggest top items
+
+  IF totals is empty THEN
+    RETURN top_items
+  END IF
+  IF limit < length of totals THEN
+    SET best = argpartition(-totals, limit)[first limit] then sort those by -totals
+  ELSE
+    SET best = argsort(-totals)                                // sparse user: fewer candidates than limit
+  END IF
+  RETURN top_items followed by model item_ids[unique_candidates[best]] with finite totals
+END
+
+
+Function: schedule_item_similarity_rebuild
+Input: none
+Output: none
+
+BEGIN
+  EVERY night at SIMILARITY_REBUILD_TIME DO
+    BUILD item similarity model
+    SIGNAL workers to load item similarity model    // workers re-map the new "current" files
+  END EVERY
+END
+
+
+Function: benchmark_item_similarity
+Input: catalog_sizes (list of integer), iterations (integer)
+Output: report (list of catalog size, p50 latency, p99 latency)
+
+BEGIN
+  CREATE empty report
+  FOR EACH size IN catalog_sizes DO
+    GENERATE synthetic model with size items and SIMILAR_NEIGHBOURS_PER_ITEM neighbours per item
+    LOAD item similarity model from the synthetic files
+
+    CREATE empty latency list
+    REPEAT iterations times
+      PICK 5 random item_ids and random weights
+      START timer
+      EXPAND similar items for the picked items with limit 10
+      ADD elapsed time to latency list
+    END REPEAT
+
+    ADD (size, 50th percentile of latency list, 99th percentile of latency list) to report
+  END FOR
+
+  RETURN report
+END
+
+
+
+Function: precompute_recommendations
+Input: worker_count (integer)
+Output: users_processed (integer), users_per_second (decimal)
+
+BEGIN
+  START timer
+  FETCH ids of all users WHERE role = "CUSTOMER" AND status = "ACTIVE" into a set
+
+  // Frequency rows are the per-customer aggregate of order_items, so one ordered
+  // pass over them reads every customer's order history exactly once
+  STREAM item frequency rows ordered by customer_id, quantity descending
+  GROUP consecutive rows by customer_id, keeping the first 5 rows of each group
+  DROP groups whose customer_id is not in the active set
+  SPLIT groups into chunks of RECOMMENDATION_CHUNK_SIZE customers
+
+  CREATE process pool with worker_count workers    // each worker loads the item similarity model
+  SET users_processed = 0
+  FOR EACH chunk result IN process pool map(compute recommendation chunk, chunks) DO
+    WRITE chunk result entries to recommendation store in one batch
+    INCREMENT users_processed by number of entries in chunk result
+  END FOR
+  CLOSE process pool
+
+  SET elapsed = timer elapsed seconds
+  SET users_per_second = users_processed / elapsed
+  LOG "Recommendations precomputed" with users_processed, elapsed, users_per_second
+  RETURN users_processed, users_per_second
+END
+
+
+Function: compute_recommendation_chunk
+Input: groups (list of customer_id with top frequency rows)
+Output: entries (list of recommendation store entries)
+
+BEGIN
+  CREATE empty entries list
+  FOR EACH group IN groups DO
+    SET top items = item_ids of group rows
+    SET top weights = quantities of group rows
+    EXPAND top items with similar items using top weights
+
+    CREATE new recommendation store entry
+    SET entry key = group customer_id
+    SET entry item_ids = expanded items
+    SET entry computed_at = current timestamp
+    ADD entry to entries list
+  END FOR
+  RETURN entries list
+END
+
+
+Function: get_stored_recommendations
+Input: customer_id (integer)
+Output: list of item_id or NOT FOUND
+
+BEGIN
+  READ recommendation store entry by customer_id
+  IF entry not found THEN
+    RETURN NOT FOUND
+  END IF
+
+  IF current timestamp - entry computed_at > RECOMMENDATION_MAX_AGE THEN
+    RETURN NOT FOUND                               // stale: caller uses the online path
+  END IF
+
+  RETURN entry item_ids
+END
+
+
+
+Function: start_chat_session
+Input: user_id (integer)
+Output: chat session object
+
+BEGIN
+  CREATE new chat session
+  SET session user_id = user_id
+  SET session started_at = current timestamp
+  SET session ended_at = NULL
+  SAVE session to database
+  RETURN session
 END
 
 
+Function: answer_question
+Input: session_id (integer), sender_type (string), question_text (string)
+Output: answer_text (string), source (string), kb_id (integer or NULL)
+
+BEGIN
+  FETCH chat session by session_id
+  IF session has ended (ended_at is not NULL) THEN
+    THROW error "Session ended"
+  END IF
+
+  CREATE new user message
+  SET message session_id = session_id
+  SET message sender_type = "USER"
+  SET message content = question_text
+  SET message source = "USER"
+  SET message created_at = current timestamp
+  APPEND user message to chat message log
+
+  SEARCH knowledge base index for best match to question_text
+  IF match found AND match is active AND match score >= KB_MATCH_THRESHOLD THEN
+    SET answer_text = knowledge base content
+    SET source = "KB"
+    SET kb_id = knowledge base id
+  ELSE
+    LOOK UP question_text in LLM answer cache
+    IF cached answer found THEN
+      SET answer_text = cached answer
+      SET source = "LLM_CACHE"
+    ELSE
+      GET LLM answer for question_text
+      SET answer_text = LLM response
+      SET source = "LLM"
+      STORE (question_text, answer_text) in LLM answer cache
+    END IF
+    SET kb_id = NULL
+  END IF
+
+  CREATE new system message
+  SET message session_id = session_id
+  SET message sender_type = "SYSTEM"
+  SET message content = answer_text
+  SET message source = source
+  SET message kb_id = kb_id
+  SET message created_at = current timestamp
+  APPEND system message to chat message log
+
+  RETURN answer_text, source, kb_id
+END
+
+
+Function: get_llm_answer
+Input: question_text (string)
+Output: answer_text (string)
+
+BEGIN
+  // LLM_CLIENT is the real API client in production and a local stub in tests
+  CALL LLM_CLIENT to get answer for question_text
+  RETURN LLM response
+END
+
+
+Function: normalize_question
+Input: question_text (string)
+Output: normalized text (string)
+
+BEGIN
+  CONVERT question_text to lower case
+  REPLACE every character that is not a letter, digit or space with a space
+  COLLAPSE runs of spaces into one and TRIM both ends
+  RETURN normalized text
+END
+
+
+Function: compute_question_signature
+Input: normalized_text (string)
+Output: signature (list of ANSWER_CACHE_NUM_HASHES integers)
+
+BEGIN
+  SET shingles = set of all 3-character substrings of normalized_text
+  IF shingles is empty THEN
+    SET shingles = {normalized_text}
+  END IF
+
+  CREATE empty signature
+  FOR h FROM 1 TO ANSWER_CACHE_NUM_HASHES DO
+    ADD minimum of hash_h(shingle) over all shingles to signature   // seeded 64-bit hashes
+  END FOR
+  RETURN signature
+END
+
+
+Function: llm_answer_cache_get
+Input: question_text (string)
+Output: cached answer (string or NULL)
+
+BEGIN
+  SET key = normalize question_text
+
+  IF key is in cache entries THEN
+    SET entry = cache entries[key]
+    IF current timestamp - entry created_at <= ANSWER_CACHE_TTL THEN
+      MOVE key to most recently used position
+      INCREMENT cache exact_hits by 1
+      RETURN entry answer
+    END IF
+    REMOVE key from LLM answer cache
+  END IF
+
+  // Locality-sensitive lookup: only entries sharing a signature band are compared
+  SET signature = compute question signature for key
+  CREATE empty candidate set
+  FOR EACH band IN signature split into ANSWER_CACHE_BANDS bands DO
+    ADD all keys in cache buckets[(band number, hash of band)] to candidate set
+  END FOR
+
+  SET best = NULL
+  FOR EACH candidate IN candidate set DO
+    SET entry = cache entries[candidate]
+    IF current timestamp - entry created_at > ANSWER_CACHE_TTL THEN
+      REMOVE candidate from LLM answer cache
+      SKIP to next candidate
+    END IF
+    SET similarity = fraction of positions where entry signature equals signature
+    IF similarity >= ANSWER_CACHE_SIMILARITY AND (best is NULL OR similarity > best similarity) THEN
+      SET best = candidate
+    END IF
+  END FOR
+
+  IF best is not NULL THEN
+    MOVE best to most recently used position
+    INCREMENT cache fuzzy_hits by 1
+    RETURN cache entries[best] answer
+  END IF
+
+  INCREMENT cache misses by 1
+  RETURN NULL
+END
+
+
+Function: llm_answer_cache_put
+Input: question_text (string), answer_text (string)
+Output: none
+
+BEGIN
+  SET key = normalize question_text
+  IF key is in cache entries THEN
+    REMOVE key from LLM answer cache
+  END IF
+
+  CREATE new cache entry
+  SET entry answer = answer_text
+  SET entry signature = compute question signature for key
+  SET entry created_at = current timestamp
+  SET cache entries[key] = entry at most recently used position
+  FOR EACH band IN entry signature split into ANSWER_CACHE_BANDS bands DO
+    ADD key to cache buckets[(band number, hash of band)]
+  END FOR
+
+  WHILE number of cache entries > ANSWER_CACHE_CAPACITY DO
+    REMOVE least recently used key from LLM answer cache
+    INCREMENT cache evictions by 1
+  END WHILE
+END
+
+
+Function: llm_answer_cache_remove
+Input: key (normalized question text)
+Output: none
+
+BEGIN
+  SET entry = cache entries[key]
+  FOR EACH band IN entry signature split into ANSWER_CACHE_BANDS bands DO
+    REMOVE key from cache buckets[(band number, hash of band)]
+  END FOR
+  DELETE cache entries[key]
+END
+
+
+Function: get_llm_answer_cache_stats
+Input: none
+Output: exact_hits, fuzzy_hits, misses, evictions, hit_rate (decimal)
+
+BEGIN
+  SET lookups = cache exact_hits + cache fuzzy_hits + cache misses
+  IF lookups = 0 THEN
+    SET hit_rate = 0
+  ELSE
+    SET hit_rate = (cache exact_hits + cache fuzzy_hits) / lookups
+  END IF
+  RETURN cache exact_hits, cache fuzzy_hits, cache misses, cache evictions, hit_rate
+END
+
+
+Function: start_chat_session_async
+Input: user_id (integer)
+Output: chat session object
+
+BEGIN
+  CREATE new chat session
+  SET session user_id = user_id
+  SET session started_at = current timestamp
+  SET session ended_at = NULL
+  AWAIT SAVE session to database
+  RETURN session
+END
+
+
+Function: answer_question_async
+Input: session_id (integer), sender_type (string), question_text (string), send_token (callback)
+Output: answer_text (string), source (string), kb_id (integer or NULL)
+
+BEGIN
+  AWAIT FETCH chat session by session_id
+  IF session has ended (ended_at is not NULL) THEN
+    THROW error "Session ended"
+  END IF
+
+  CREATE new user message
+  SET message session_id = session_id
+  SET message sender_type = "USER"
+  SET message content = question_text
+  SET message source = "USER"
+  SET message created_at = current timestamp
+  AWAIT APPEND user message to chat message log
+
+  SEARCH knowledge base index for best match to question_text
+  IF match found AND match is active AND match score >= KB_MATCH_THRESHOLD THEN
+    SET answer_text = knowledge base content
+    SET source = "KB"
+    SET kb_id = knowledge base id
+    AWAIT send_token(answer_text)
+  ELSE
+    LOOK UP question_text in LLM answer cache
+    IF cached answer found THEN
+      SET answer_text = cached answer
+      SET source = "LLM_CACHE"
+      SET kb_id = NULL
+      AWAIT send_token(answer_text)
+    ELSE
+      TRY
+        AWAIT streamed LLM answer for question_text with send_token and LLM_TIMEOUT_SECONDS
+        SET answer_text = LLM response
+        SET source = "LLM"
+        SET kb_id = NULL
+        STORE (question_text, answer_text) in LLM answer cache
+      CATCH timeout or LLM error
+        // The client may already hold partial LLM text; have it drop that before the fallback
+        AWAIT send_token(DISCARD_STREAM)
+
+        // Fall back to the best KB match even below the threshold
+        IF match found AND match is active THEN
+          SET answer_text = knowledge base content
+          SET source = "KB"
+          SET kb_id = knowledge base id
+        ELSE
+          SET answer_text = LLM_FALLBACK_MESSAGE
+          SET source = "FALLBACK"
+          SET kb_id = NULL
+        END IF
+        AWAIT send_token(answer_text)
+      END TRY
+    END IF
+  END IF
+
+  CREATE new system message
+  SET message session_id = session_id
+  SET message sender_type = "SYSTEM"
+  SET message content = answer_text
+  SET message source = source
+  SET message kb_id = kb_id
+  SET message created_at = current timestamp
+  AWAIT APPEND system message to chat message log
+
+  RETURN answer_text, source, kb_id
+END
+
+
+Function: stream_llm_answer
+Input: question_text (string), send_token (callback), timeout_seconds (decimal)
+Output: answer_text (string)
+
+BEGIN
+  SET key = normalize question_text
+
+  // Coalesce identical in-flight questions onto one LLM call. The call runs as its own
+  // task, so one caller timing out does not cancel it for the others
+  IF key is not in in_flight map THEN
+    CREATE new in-flight call with empty buffer, empty subscribers and a done event
+    SET in_flight[key] = call
+    START task: run LLM call for key and question_text
+  END IF
+  SET call = in_flight[key]
+
+  // Each waiter has its own token queue drained by its own sender task, so a slow or
+  // disconnected client never holds up the LLM stream or the other waiters.
+  // Nothing awaits between copying the buffer and subscribing, so no token is missed or repeated
+  CREATE new subscriber with an unbounded token queue
+  PUT every token in call buffer into subscriber queue
+  ADD subscriber to call subscribers
+  START task as subscriber sender:
+    TRY
+      LOOP
+        AWAIT GET token from subscriber queue
+        IF token is END_OF_STREAM THEN
+          STOP
+        END IF
+        AWAIT send_token(token)
+      END LOOP
+    CATCH error
+      SET subscriber send error = error          // only this waiter sees it
+      REMOVE subscriber from call subscribers
+    END TRY
+
+  TRY
+    AWAIT call done event within timeout_seconds
+  CATCH timeout
+    REMOVE subscriber from call subscribers     // on timeout the client gets no more LLM tokens
+    CANCEL subscriber sender
+    THROW timeout
+  END TRY
+
+  AWAIT subscriber sender finished              // the client's own pace only delays this waiter
+  IF subscriber send error is set THEN
+    THROW subscriber send error
+  END IF
+  IF call error is set THEN
+    THROW call error                            // every waiter sees the same LLM failure
+  END IF
+  RETURN call result
+END
+
+
+Function: run_llm_call
+Input: key (normalized question text), question_text (string)
+Output: none
+
+BEGIN
+  SET call = in_flight[key]
+  TRY
+    AWAIT ACQUIRE LLM semaphore (LLM_MAX_CONCURRENCY permits)
+    TRY
+      FOR EACH token IN AWAIT LLM_CLIENT stream answer for question_text DO
+        ADD token to call buffer
+        // Never awaits a client: send errors stay in each subscriber's sender task
+        FOR EACH subscriber IN call subscribers DO
+          PUT token into subscriber queue without waiting
+        END FOR
+      END FOR
+    FINALLY
+      RELEASE LLM semaphore
+    END TRY
+    SET call result = joined call buffer
+  CATCH error
+    SET call error = error                      // LLM failures only
+  FINALLY
+    DELETE in_flight[key]
+    FOR EACH subscriber IN call subscribers DO
+      PUT END_OF_STREAM into subscriber queue without waiting
+    END FOR
+    SET call done event
+  END TRY
+END
+
+
+Function: run_fake_llm_server
+Input: port (integer), latency_seconds (decimal), tokens_per_second (integer)
+Output: none
+
+BEGIN
+  LISTEN for HTTP requests on localhost port
+  FOR EACH request DO
+    INCREMENT server request_count by 1
+    AWAIT sleep latency_seconds                  // injected time-to-first-token
+    FOR EACH word IN canned answer for the request's question DO
+      STREAM word to the client
+      AWAIT sleep 1 / tokens_per_second
+    END FOR
+  END FOR
+END
+
+
+Function: benchmark_async_chat
+Input: concurrent_users (integer), questions_per_user (integer), latency_seconds (decimal)
+Output: answers_per_second (decimal), llm_request_count (integer), timeout_count (integer)
+
+BEGIN
+  START fake LLM server with latency_seconds
+  SET LLM_CLIENT = client pointed at the fake LLM server
+
+  START timer
+  RUN concurrent_users tasks concurrently, each:
+    START chat session async
+    FOR i FROM 1 TO questions_per_user DO
+      AWAIT answer question async with a question drawn from a small shared pool
+    END FOR
+  SET elapsed = timer elapsed seconds
+
+  // Shared questions asked at the same time should reach the server once
+  RETURN (concurrent_users × questions_per_user) / elapsed, server request_count, number of "FALLBACK" or timed out answers
+END
+
+
+Function: append_chat_message
+Input: message (chat message)
+Output: none
+
+BEGIN
+  // CHAT_LOG_DURABILITY is "SYNC", "GROUP_COMMIT" or "ASYNC"
+  IF CHAT_LOG_DURABILITY equals "SYNC" THEN
+    SAVE message to database
+    RETURN
+  END IF
+
+  ACQUIRE chat log lock
+  ADD message to chat log buffer
+  SET batch = current chat log batch number
+  IF CHAT_LOG_DURABILITY equals "GROUP_COMMIT" THEN
+    INCREMENT chat log batch_waiters[batch] by 1    // keeps the batch result until this appender reads it
+  END IF
+  IF size of chat log buffer >= CHAT_LOG_MAX_BATCH THEN
+    SIGNAL chat log flusher
+  END IF
+  RELEASE chat log lock
+
+  IF CHAT_LOG_DURABILITY equals "GROUP_COMMIT" THEN
+    WAIT until chat log batch_results has an entry for batch    // one commit covers every waiter
+    ACQUIRE chat log lock
+    SET result = chat log batch_results[batch]
+    DECREMENT chat log batch_waiters[batch] by 1
+    IF chat log batch_waiters[batch] = 0 THEN
+      DELETE chat log batch_waiters[batch]
+      DELETE chat log batch_results[batch]      // the last waiter of the batch has read it
+    END IF
+    RELEASE chat log lock
+    IF result is an error THEN
+      THROW error "Message not saved"
+    END IF
+  END IF
+END
+
+
+Function: flush_chat_message_log
+Input: none
+Output: flushed_count (integer)
+
+BEGIN
+  ACQUIRE chat log lock
+  SET messages = chat log buffer
+  SET batch = current chat log batch number
+  SET chat log buffer = empty list
+  INCREMENT chat log batch number by 1
+  RELEASE chat log lock
+
+  SET result = "OK"
+  IF messages is not empty THEN
+    FOR attempt FROM 1 TO CHAT_LOG_FLUSH_ATTEMPTS DO
+      TRY
+        BEGIN database transaction
+        INSERT all messages into chat messages in one bulk statement
+        COMMIT database transaction
+        SET result = "OK"
+        STOP retrying
+      CATCH error
+        ROLLBACK database transaction
+        SET result = error
+        WAIT CHAT_LOG_RETRY_DELAY × 2 ^ (attempt - 1)
+      END TRY
+    END FOR
+  END IF
+
+  IF result is an error THEN
+    LOG "Chat log flush failed" with batch, number of messages and result
+    IF CHAT_LOG_DURABILITY equals "ASYNC" THEN
+      // Nobody is waiting to hear about these; keep them for replay_chat_dead_letters
+      APPEND messages to chat log dead-letter file
+      FLUSH and FSYNC chat log dead-letter file
+    END IF
+    // GROUP_COMMIT appenders are told below that their message was not saved
+  END IF
+
+  ACQUIRE chat log lock
+  IF batch is in chat log batch_waiters THEN
+    // Kept until every waiter has read it, however late it is scheduled;
+    // batches nobody waits on (empty or ASYNC) store nothing
+    SET chat log batch_results[batch] = result
+  END IF
+  RELEASE chat log lock
+  WAKE all appenders waiting on batch
+  IF result is an error THEN
+    RETURN 0
+  END IF
+  RETURN number of messages
+END
+
+
+Function: replay_chat_dead_letters
+Input: none
+Output: replayed_count (integer)
+
+BEGIN
+  READ all messages from chat log dead-letter file
+  IF there are none THEN
+    RETURN 0
+  END IF
+
+  BEGIN database transaction
+  INSERT the messages into chat messages in one bulk statement
+  COMMIT database transaction
+
+  TRUNCATE chat log dead-letter file
+  RETURN number of messages
+END
+
+
+Function: run_chat_message_flusher
+Input: none
+Output: none
+
+BEGIN
+  WHILE chat log is not shutting down DO
+    WAIT for flusher signal or CHAT_LOG_FLUSH_INTERVAL, whichever comes first
+    TRY
+      FLUSH chat message log
+    CATCH error
+      LOG "Chat log flusher error" with error      // keep the flusher alive
+    END TRY
+  END WHILE
+END
+
+
+Function: shutdown_chat_message_log
+Input: none
+Output: none
+
+BEGIN
+  SET chat log shutting down = TRUE
+  SIGNAL chat log flusher
+  WAIT for chat message flusher to stop
+  FLUSH chat message log                         // drain anything appended during shutdown
+END
+
+
+Function: benchmark_chat_message_writes
+Input: message_count (integer), writer_count (integer)
+Output: report (list of durability mode, messages per second)
+
+BEGIN
+  CREATE empty report
+  FOR EACH mode IN ["SYNC", "GROUP_COMMIT", "ASYNC"] DO
+    SET CHAT_LOG_DURABILITY = mode
+    START chat message flusher
+    START timer
+    RUN writer_count threads, each appending message_count / writer_count synthetic messages
+    SHUTDOWN chat message log
+    SET elapsed = timer elapsed seconds
+    ADD (mode, message_count / elapsed) to report
+  END FOR
+  RETURN report
+END
+
+
+Function: rate_answer
+Input: user_id (integer), kb_id (integer), rating_value (integer 0-5)
+Output: none
+
+BEGIN
+  IF rating_value < 0 OR rating_value > 5 THEN
+    THROW error "Invalid rating"
+  END IF
+
+  FETCH knowledge base entry by kb_id
+  IF knowledge base entry not found THEN
+    THROW error "Not found"
+  END IF
+
+  BEGIN database transaction
+
+  CREATE new rating record
+  SET rating user_id = user_id
+  SET rating kb_id = kb_id
+  SET rating value = rating_value
+  SET rating created_at = current timestamp
+  SAVE rating to database
+
+  // Single atomic UPDATE on the row, so the cost does not grow with the number of ratings
+  UPDATE knowledge base entry WHERE kb_id = kb_id:
+    SET rating_sum = rating_sum + rating_value
+    SET rating_count = rating_count + 1
+    SET flag_count = flag_count + (1 if rating_value = 0, else 0)
+    SET avg_rating = (rating_sum + rating_value) / (rating_count + 1)
+    SET updated_at = current timestamp
+    IF rating_value = 0 THEN
+      SET is_active = FALSE
+    END IF
+
+  COMMIT database transaction
+
+  IF rating_value = 0 THEN
+    REMOVE kb_id from knowledge base index
+    PUBLISH kb_id deactivation to the other application processes    // each removes it from its own index
+  END IF
+END
+
+
+Function: reconcile_kb_rating_aggregates
+Input: fix (boolean)
+Output: checked_count (integer), drifted (list of kb_id, stored values, recomputed values)
+
+BEGIN
+  // Both reads come from one snapshot, so ratings and stored totals agree with each other
+  BEGIN read-only database transaction (REPEATABLE READ)
+  FETCH per kb_id SUM(value), COUNT(*), SUM(CASE WHEN value = 0 THEN 1 ELSE 0 END)
+    from knowledge base ratings GROUP BY kb_id
+  FETCH kb_id, rating_sum, rating_count, flag_count of all knowledge base entries
+  COMMIT database transaction
+
+  CREATE empty drifted list
+  SET skipped_count = 0
+  FOR EACH entry IN knowledge base entries DO
+    SET expected = grouped totals for entry kb_id, or (0, 0, 0) if it has no ratings
+    IF (entry rating_sum, entry rating_count, entry flag_count) does not equal expected THEN
+      ADD (entry kb_id, stored values, expected) to drifted list
+      IF fix THEN
+        // Only correct rows nobody has rated since the snapshot; otherwise a new
+        // increment would be overwritten. Skipped rows are picked up by the next run
+        UPDATE knowledge base entry WHERE kb_id = entry kb_id
+            AND rating_sum = entry rating_sum AND rating_count = entry rating_count
+            AND flag_count = entry flag_count:
+          SET rating_sum, rating_count, flag_count = expected
+          SET avg_rating = expected sum / expected count, or NULL if count is 0
+        IF no row was updated THEN
+          INCREMENT skipped_count by 1
+        END IF
+      END IF
+    END IF
+  END FOR
+
+  LOG "KB rating reconciliation" with number of entries, size of drifted list and skipped_count
+  RETURN number of entries, drifted list
+END
+
+
+Function: tokenize_text
+Input: text (string)
+Output: list of terms
+
+BEGIN
+  CONVERT text to lower case
+  SPLIT text on any character that is not a letter or digit
+  DROP empty tokens and tokens in STOP_WORDS
+  RETURN remaining tokens
+END
+
+
+Function: build_kb_search_index
+Input: corpus (list of knowledge base entries, or NULL to load from the database)
+Output: none
+
+BEGIN
+  CREATE new knowledge base index
+  SET index postings = empty map of term to map of kb_id to term frequency
+  SET index doc_lengths = empty map of kb_id to term count
+  SET index entries = empty map of kb_id to knowledge base entry
+  SET index total_length = 0
+
+  IF corpus is NULL THEN
+    FETCH all knowledge base entries WHERE is_active = TRUE
+    SET corpus = knowledge base entries
+  END IF
+  FOR EACH entry IN corpus WHERE entry is_active = TRUE DO
+    ADD entry to knowledge base index
+  END FOR
+
+  REPLACE current knowledge base index with the new index
+END
+
+
+Function: kb_index_add_entry
+Input: entry (knowledge base entry)
+Output: none
+
+BEGIN
+  IF entry kb_id is in index entries THEN
+    REMOVE entry kb_id from knowledge base index
+  END IF
+
+  SET terms = tokenize entry question text and entry content
+  FOR EACH term IN terms DO
+    INCREMENT index postings[term][entry kb_id] by 1
+  END FOR
+
+  SET index doc_lengths[entry kb_id] = number of terms
+  SET index entries[entry kb_id] = entry
+  INCREMENT index total_length by number of terms
+END
+
 
-Function: start_chat_session
-Input: user_id (integer)
-Output: chat session object
+Function: kb_index_remove_entry
+Input: kb_id (integer)
+Output: none
 
 BEGIN
-  CREATE new chat session
-  SET session user_id = user_id
-  SET session started_at = current timestamp
-  SET session ended_at = NULL
-  SAVE session to database
-  RETURN session
+  IF kb_id not in index entries THEN
+    RETURN
+  END IF
+
+  SET terms = tokenize index entries[kb_id] question text and content
+  FOR EACH distinct term IN terms DO
+    DELETE index postings[term][kb_id]
+    IF index postings[term] is empty THEN
+      DELETE index postings[term]
+    END IF
+  END FOR
+
+  DECREMENT index total_length by index doc_lengths[kb_id]
+  DELETE index doc_lengths[kb_id]
+  DELETE index entries[kb_id]
 END
 
 
-Function: answer_question
-Input: session_id (integer), sender_type (string), question_text (string)
-Output: answer_text (string), source (string), kb_id (integer or NULL)
+Function: search_knowledge_base
+Input: question_text (string)
+Output: match (knowledge base entry or NULL), score (decimal)
 
 BEGIN
-  FETCH chat session by session_id
-  IF session has ended (ended_at is not NULL) THEN
-    THROW error "Session ended"
+  SET N = number of index entries
+  IF N = 0 THEN
+    RETURN NULL, 0
   END IF
 
-  CREATE new user message
-  SET message session_id = session_id
-  SET message sender_type = "USER"
-  SET message content = question_text
-  SET message source = "USER"
-  SET message created_at = current timestamp
-  SAVE user message to database
+  SET average_length = index total_length / N
+  CREATE empty score map of kb_id to decimal
 
-  SEARCH knowledge base for best match to question_text
-  IF match found AND match is active THEN
-    SET answer_text = knowledge base content
-    SET source = "KB"
-    SET kb_id = knowledge base id
-  ELSE
-    CALL LLM API to get answer for question_text
-    SET answer_text = LLM response
-    SET source = "LLM"
-    SET kb_id = NULL
-  END IF
+  // BM25 over the posting lists of the query terms only
+  FOR EACH distinct term IN tokenize question_text DO
+    IF term not in index postings THEN
+      SKIP to next term
+    END IF
 
-  CREATE new system message
-  SET message session_id = session_id
-  SET message sender_type = "SYSTEM"
-  SET message content = answer_text
-  SET message source = source
-  SET message kb_id = kb_id
-  SET message created_at = current timestamp
-  SAVE system message to database
+    SET df = number of entries in index postings[term]
+    SET idf = ln(1 + (N - df + 0.5) / (df + 0.5))
+    FOR EACH (kb_id, tf) IN index postings[term] DO
+      SET length_norm = 1 - BM25_B + BM25_B × index doc_lengths[kb_id] / average_length
+      INCREMENT score[kb_id] by idf × tf × (BM25_K1 + 1) / (tf + BM25_K1 × length_norm)
+    END FOR
+  END FOR
 
-  RETURN answer_text, source, kb_id
+  IF score map is empty THEN
+    RETURN NULL, 0
+  END IF
+
+  SET best_id = kb_id with the highest score
+  RETURN index entries[best_id], score[best_id]
 END
 
 
-Function: rate_answer
-Input: user_id (integer), kb_id (integer), rating_value (integer 0-5)
-Output: none
+Function: generate_kb_benchmark_corpus
+Input: entry_count (integer), seed (integer)
+Output: corpus (list of knowledge base entries), queries (list of question text and expected kb_id)
 
 BEGIN
-  IF rating_value < 0 OR rating_value > 5 THEN
-    THROW error "Invalid rating"
-  END IF
+  SEED random generator with seed
+  LOAD restaurant vocabulary (menu terms, delivery terms, account terms, filler words)
+
+  CREATE empty corpus
+  FOR i FROM 1 TO entry_count DO
+    CREATE knowledge base entry with kb_id = i
+    SET entry question text = 6 to 12 words drawn Zipf-distributed from the vocabulary
+    SET entry content = 20 to 60 words drawn Zipf-distributed from the vocabulary
+    SET entry is_active = TRUE
+    ADD entry to corpus
+  END FOR
 
-  FETCH knowledge base entry by kb_id
-  IF knowledge base entry not found THEN
-    THROW error "Not found"
-  END IF
+  CREATE empty queries
+  REPEAT 1000 times
+    PICK a random entry from corpus
+    SET query = entry question text with two words dropped and one word substituted
+    ADD (query, entry kb_id) to queries
+  END REPEAT
 
-  CREATE new rating record
-  SET rating user_id = user_id
-  SET rating kb_id = kb_id
-  SET rating value = rating_value
-  SET rating created_at = current timestamp
-  SAVE rating to database
+  RETURN corpus, queries
+END
 
-  FETCH all ratings for this kb_id
-  CALCULATE average rating from all ratings
-  COUNT how many ratings equal 0 (flags)
-  UPDATE knowledge base entry:
-    SET avg_rating = calculated average
-    SET flag_count = count of zero ratings
-    SET updated_at = current timestamp
-    IF rating_value = 0 THEN
-      SET is_active = FALSE
+
+Function: benchmark_kb_search
+Input: entry_count (integer)
+Output: build_seconds (decimal), p50 latency, p99 latency, top1_accuracy (decimal)
+
+BEGIN
+  GENERATE kb benchmark corpus with entry_count entries and seed 322
+
+  START timer
+  BUILD knowledge base search index with corpus
+  SET build_seconds = timer elapsed seconds
+
+  CREATE empty latency list
+  SET correct = 0
+  FOR EACH (query, expected_id) IN queries DO
+    START timer
+    SEARCH knowledge base for query
+    ADD elapsed time to latency list
+    IF match kb_id equals expected_id THEN
+      INCREMENT correct by 1
     END IF
-  SAVE updated knowledge base entry
+  END FOR
+
+  RETURN build_seconds, 50th percentile of latency list, 99th percentile of latency list, correct / number of queries
 END
 
 
@@ -198,11 +1485,16 @@ BEGIN
     RETURN FALSE, "Weak password"
   END IF
 
+  AWAIT hash of raw_password from password hashing pool
+  IF password hashing pool is full THEN
+    RETURN FALSE, "Try again"
+  END IF
+
   CREATE new user record
   SET user name = name
   SET user email = email
   SET user phone = phone
-  SET user password_hash = hashed version of raw_password
+  SET user password_hash = computed hash
   SET user status = "PENDING"
   SET user role = "CUSTOMER"
   SET user warning_count = 0
@@ -213,6 +1505,7 @@ BEGIN
   CREATE new customer record
   SET customer customer_id = user's user_id
   SET customer balance = 0
+  SET customer balance_version = 0
   SET customer total_orders = 0
   SET customer total_spent = 0
   SET customer is_vip = FALSE
@@ -237,16 +1530,200 @@ BEGIN
     RETURN FALSE, "Inactive", NULL
   END IF
 
-  VERIFY raw_password against user's password_hash
+  CHECK if user email OR user phone is blacklisted
+  IF blacklisted THEN
+    RETURN FALSE, "Inactive", NULL
+  END IF
+
+  AWAIT verification of raw_password against user's password_hash from password hashing pool
+  IF password hashing pool is full THEN
+    RETURN FALSE, "Try again", NULL
+  END IF
   IF password does not match THEN
     RETURN FALSE, "Invalid", NULL
   END IF
 
-  CREATE new session token for user_id with 30 minute expiration
+  IF user's password_hash was made with parameters other than PASSWORD_HASH_PARAMS THEN
+    // Only possible right after a successful verify, while the raw password is at hand
+    START task:
+      AWAIT hash of raw_password from password hashing pool
+      IF password hashing pool is full THEN
+        SKIP the rehash                           // retried on a later login
+      ELSE
+        UPDATE user SET password_hash = computed hash
+          WHERE user_id = user's user_id AND password_hash = the hash just verified
+      END IF
+  END IF
+
+  CREATE signed session token for user with 30 minute expiration
   RETURN TRUE, "OK", token
 END
 
 
+Function: create_session_token
+Input: user (user object), lifetime (duration)
+Output: token (string)
+
+BEGIN
+  SET payload user_id = user's user_id
+  SET payload role = user's role
+  SET payload issued_at = current timestamp
+  SET payload expires_at = current timestamp + lifetime
+  SET body = base64url of compact-encoded payload
+  SET signature = base64url of HMAC-SHA256(SESSION_SIGNING_KEY, body)
+  RETURN body + "." + signature
+END
+
+
+Function: validate_session_token
+Input: token (string)
+Output: valid (boolean), user_id (integer or NULL), role (string or NULL)
+
+BEGIN
+  // No database access: signature, expiry and revocation are all checked in memory
+  SPLIT token on "." into body and signature
+  IF token does not have exactly two parts THEN
+    RETURN FALSE, NULL, NULL
+  END IF
+
+  SET expected = base64url of HMAC-SHA256(SESSION_SIGNING_KEY, body)
+  IF constant-time comparison of signature and expected fails THEN
+    RETURN FALSE, NULL, NULL
+  END IF
+
+  DECODE payload from body
+  IF payload expires_at <= current timestamp THEN
+    RETURN FALSE, NULL, NULL
+  END IF
+
+  IF payload user_id is in revoked sessions AND payload issued_at <= revoked sessions[payload user_id] THEN
+    RETURN FALSE, NULL, NULL
+  END IF
+
+  RETURN TRUE, payload user_id, payload role
+END
+
+
+Function: revoke_user_sessions
+Input: user_id (integer)
+Output: none
+
+BEGIN
+  SET revoked_at = current timestamp
+  SET revoked sessions[user_id] = revoked_at
+  SAVE (user_id, revoked_at) to session revocations    // so other processes and restarts see it
+  PUBLISH (user_id, revoked_at) to the other application processes
+
+  // Tokens live at most SESSION_TOKEN_LIFETIME, so older revocations can be dropped
+  REMOVE from revoked sessions every entry older than current timestamp - SESSION_TOKEN_LIFETIME
+END
+
+
+Function: load_session_revocations
+Input: none
+Output: none
+
+BEGIN
+  FETCH session revocations WHERE revoked_at > current timestamp - SESSION_TOKEN_LIFETIME
+  FOR EACH revocation IN session revocations DO
+    SET revoked sessions[revocation user_id] = revocation revoked_at
+  END FOR
+END
+
+
+Function: benchmark_token_validation
+Input: token_count (integer), revoked_count (integer)
+Output: validations_per_second (decimal), nanoseconds_per_validation (decimal)
+
+BEGIN
+  CREATE token_count tokens for random users
+  REVOKE sessions of revoked_count random users
+  START timer
+  FOR EACH token IN tokens DO
+    VALIDATE session token
+  END FOR
+  SET elapsed = timer elapsed seconds
+  RETURN token_count / elapsed, elapsed × 1000000000 / token_count
+END
+
+
+
+Function: start_password_hash_pool
+Input: worker_count (integer)
+Output: none
+
+BEGIN
+  // Separate processes so CPU-heavy hashing never blocks the request workers
+  CREATE process pool with worker_count workers
+  SET hash pool in_flight = 0
+  SET hash pool limit = worker_count × PASSWORD_HASH_QUEUE_PER_WORKER
+END
+
+
+Function: submit_password_hash_job
+Input: job (hash or verify request)
+Output: result, or POOL_FULL
+
+BEGIN
+  // Bounded queue: shed load instead of letting waits grow without limit
+  IF hash pool in_flight >= hash pool limit THEN
+    INCREMENT hash pool rejected by 1
+    RETURN POOL_FULL
+  END IF
+
+  INCREMENT hash pool in_flight by 1
+  TRY
+    AWAIT run job on process pool
+    RETURN job result
+  FINALLY
+    DECREMENT hash pool in_flight by 1
+  END TRY
+END
+
+
+Function: hash_password
+Input: raw_password (string)
+Output: password_hash (string)
+
+BEGIN
+  // Runs in a pool process
+  GENERATE random salt
+  COMPUTE hash of raw_password with salt using PASSWORD_HASH_ALGORITHM and PASSWORD_HASH_PARAMS
+  RETURN encoded string of algorithm, parameters, salt and hash
+END
+
+
+Function: verify_password
+Input: raw_password (string), password_hash (string)
+Output: matches (boolean)
+
+BEGIN
+  // Runs in a pool process
+  DECODE algorithm, parameters, salt and hash from password_hash
+  COMPUTE hash of raw_password with the decoded salt, algorithm and parameters
+  RETURN constant-time comparison of computed hash and decoded hash
+END
+
+
+Function: benchmark_login_throughput
+Input: pool_sizes (list of integer), login_count (integer), concurrency (integer)
+Output: report (list of pool size, logins per second, p99 latency)
+
+BEGIN
+  CREATE test users whose passwords are hashed with PASSWORD_HASH_PARAMS
+  CREATE empty report
+  FOR EACH size IN pool_sizes DO
+    START password hash pool with size workers
+    START timer
+    RUN login_count logins with concurrency concurrent clients
+    SET elapsed = timer elapsed seconds
+    ADD (size, login_count / elapsed, 99th percentile login latency) to report
+    STOP password hash pool
+  END FOR
+  LOG report with the number of CPU cores
+  RETURN report
+END
+
 
 Function: review_registration
 Input: manager_id (integer), user_id (integer), decision (string), reason (string)
@@ -294,21 +1771,132 @@ BEGIN
     RETURN FALSE, "Payment failed"
   END IF
 
-  INCREMENT customer balance by amount
-  SAVE customer to database
+  APPLY balance change of +amount to customer_id with reason "DEPOSIT" and reference = gateway charge id
+  IF balance change result is not "OK" THEN
+    ISSUE refund for amount via payment gateway
+    LOG transaction with status "FAILED"
+    RETURN FALSE, "Try again"
+  END IF
+
   LOG transaction with status "SUCCESS"
   RETURN TRUE, "Deposit ok"
 END
 
 
+Function: apply_balance_change
+Input: customer_id (integer), delta (decimal, or "ALL" to withdraw the whole balance), reason (string), reference_id (integer or NULL), counter_updates (list or NULL)
+Output: result ("OK", "INSUFFICIENT" or "CONFLICT"), applied_delta (decimal)
+
+BEGIN
+  // Runs inside the caller's transaction if one is open, otherwise in its own
+  FOR attempt FROM 1 TO BALANCE_MAX_RETRIES DO
+    IF a database transaction is open THEN
+      // A plain read would return the transaction's snapshot on every retry, so lock
+      // the row instead; callers take it last, so it is held only until their commit
+      FETCH balance, balance_version of customer by customer_id FOR UPDATE
+    ELSE
+      FETCH balance, balance_version of customer by customer_id     // plain read, no row lock
+    END IF
+
+    IF delta equals "ALL" THEN
+      SET applied_delta = -balance
+    ELSE
+      SET applied_delta = delta
+    END IF
+
+    IF balance + applied_delta < 0 THEN
+      RETURN "INSUFFICIENT", 0
+    END IF
+
+    // Compare-and-swap: only succeeds if nobody changed the balance since the read
+    UPDATE customer WHERE customer_id = customer_id AND balance_version = read balance_version:
+      SET balance = balance + applied_delta
+      SET balance_version = balance_version + 1
+      APPLY counter_updates, if any
+    IF one row was updated THEN
+      CREATE new ledger entry
+      SET entry customer_id = customer_id
+      SET entry delta = applied_delta
+      SET entry balance_after = balance + applied_delta
+      SET entry version = balance_version + 1
+      SET entry reason = reason
+      SET entry reference_id = reference_id
+      SET entry created_at = current timestamp
+      SAVE entry to balance ledger
+
+      IF customer_id is in the unit of work open in this context THEN
+        SET its balance, balance_version and counters to the values just written   // not marked changed
+      END IF
+      RETURN "OK", applied_delta
+    END IF
+
+    WAIT random time up to BALANCE_RETRY_BASE_DELAY × 2 ^ (attempt - 1)    // jittered backoff
+  END FOR
+
+  RETURN "CONFLICT", 0
+END
+
+
+Function: refund_customer_balance
+Input: customer_id (integer)
+Output: none
+
+BEGIN
+  APPLY balance change of "ALL" to customer_id with reason "REFUND"
+  IF balance change result is not "OK" THEN
+    THROW error "Balance busy"                  // caller must not close the account yet
+  END IF
+
+  SET withdrawn = -applied_delta
+  IF withdrawn = 0 THEN
+    RETURN
+  END IF
+
+  ISSUE refund for withdrawn via payment gateway
+  IF refund fails THEN
+    // Put the money back so it is not lost; the account stays open until a refund succeeds
+    APPLY balance change of +withdrawn to customer_id with reason "REFUND_REVERSAL"
+    LOG "Refund failed" with customer_id, withdrawn and the reversal result
+    THROW error "Refund failed"
+  END IF
+END
+
+
+Function: stress_test_balance_ledger
+Input: thread_count (integer), operations_per_thread (integer), starting_balance (decimal)
+Output: passed (boolean)
+
+BEGIN
+  CREATE test customer with balance = starting_balance and balance_version = 0
+  CREATE thread-safe list of applied deltas
+
+  RUN thread_count threads at once, each operations_per_thread times:
+    PICK delta at random from deposits (+10 to +100) and debits (-10 to -100)
+    APPLY balance change of delta to the test customer with reason "STRESS"
+    IF balance change result is "OK" THEN
+      ADD applied delta to list of applied deltas
+    END IF
+  WAIT for all threads
+
+  FETCH test customer balance and balance_version
+  FETCH all ledger entries for the test customer ordered by version
+
+  SET passed = customer balance equals starting_balance + sum of applied deltas
+               AND customer balance equals starting_balance + sum of ledger entry deltas
+               AND ledger versions are exactly 1 to customer balance_version with no gaps
+               AND no ledger entry has balance_after < 0
+  RETURN passed
+END
+
+
 
 Function: place_order
 Input: customer_id (integer), cart_items (list of cart item objects)
 Output: success (boolean), message (string), order_id (integer or NULL)
 
 BEGIN
-  FETCH customer by customer_id
-  FETCH user by customer_id
+  GET customer by customer_id from unit of work
+  GET user by customer_id from unit of work
 
   IF user status is not "ACTIVE" THEN
     RETURN FALSE, "Account inactive", NULL
@@ -318,16 +1906,16 @@ BEGIN
     RETURN FALSE, "Suspended", NULL
   END IF
 
+  LOAD cart menu items for cart_items into item map
   FOR EACH cart_item IN cart_items DO
-    FETCH menu item by cart_item's item_id
-    IF menu item is not available THEN
+    IF cart_item's item_id not in item map OR item map[item_id] is not available THEN
       RETURN FALSE, "Item unavailable", NULL
     END IF
   END FOR
 
   SET is_vip = customer's VIP status
   CHECK free delivery eligibility for customer
-  CALCULATE order total based on cart_items, is_vip, is_free_delivery
+  CALCULATE order total based on cart_items, is_vip, is_free_delivery, item map
 
   IF customer balance < total THEN
     ADD warning to user with source "ORDER" and reason "Insufficient balance"
@@ -336,9 +1924,6 @@ BEGIN
 
   BEGIN database transaction
 
-  DECREMENT customer balance by total
-  SAVE customer to database
-
   CREATE new order
   SET order customer_id = customer_id
   SET order status = "PLACED"
@@ -349,58 +1934,227 @@ BEGIN
   SET order created_at = current timestamp
   SAVE order to database
 
+  CREATE empty order items list
   FOR EACH cart_item IN cart_items DO
     CREATE new order item
     SET order_item order_id = order's order_id
     SET order_item item_id = cart_item's item_id
     SET order_item quantity = cart_item's quantity
-    FETCH menu item price
-    SET order_item unit_price = menu item price
-    SAVE order_item to database
+    SET order_item unit_price = item map[cart_item's item_id] price
+    ADD order_item to order items list
   END FOR
+  INSERT order items list into order items in one bulk statement
+
+  UPDATE item frequency profile for customer_id with the new order items
+
+  // Touch the customer row last and once, so its lock is held only until commit
+  APPLY balance change of -total to customer_id with reason "ORDER", reference = order's order_id
+    and counter_updates = [total_orders + 1, total_spent + total]
+  IF balance change result is "INSUFFICIENT" THEN
+    ROLLBACK database transaction
+    RETURN FALSE, "Not enough balance", NULL
+  ELSE IF balance change result is "CONFLICT" THEN
+    ROLLBACK database transaction
+    RETURN FALSE, "Try again", NULL
+  END IF
 
   COMMIT database transaction
 
-  INCREMENT customer total_orders by 1
-  INCREMENT customer total_spent by total
-  SAVE customer to database
+  DELETE recommendation store entry for customer_id    // new history, fall back online until next run
 
   CHECK if customer qualifies for VIP upgrade
   OPEN bidding window for this order
 
-  RETURN TRUE, "Order placed", order's order_id
+  RETURN TRUE, "Order placed", order's order_id
+END
+
+
+Function: calculate_order_total
+Input: cart_items (list), is_vip (boolean), is_free_delivery (boolean), item_map (map of item_id to menu item, or NULL)
+Output: total (decimal)
+
+BEGIN
+  IF item_map is NULL THEN
+    LOAD cart menu items for cart_items into item_map
+  END IF
+
+  SET subtotal = 0
+
+  FOR EACH cart_item IN cart_items DO
+    INCREMENT subtotal by (item_map[cart_item's item_id] price × cart_item quantity)
+  END FOR
+
+  IF is_vip THEN
+    SET discount = subtotal × 0.05
+  ELSE
+    SET discount = 0
+  END IF
+
+  SET taxes = subtotal × TAX_RATE
+
+  IF is_free_delivery THEN
+    SET delivery_fee = 0
+  ELSE
+    SET delivery_fee = BASE_DELIVERY_FEE
+  END IF
+
+  SET total = subtotal - discount + taxes + delivery_fee
+  ROUND total to 2 decimal places (half up)
+  RETURN total
+END
+
+
+Function: price_carts_bulk
+Input: carts (list of cart_items), is_vip (list of boolean), is_free_delivery (list of boolean)
+Output: subtotal, discount, taxes, delivery_fee, total (arrays of decimal, one entry per cart)
+
+BEGIN
+  // Exact integer arithmetic: amounts in cents and rates as integers over RATE_SCALE,
+  // so every result matches calculate_order_total to the cent
+  SET RATE_SCALE = 10 ^ (largest number of decimal places in TAX_RATE and 0.05)
+  SET tax_units = TAX_RATE as Decimal × RATE_SCALE
+  SET vip_discount_units = 0.05 as Decimal × RATE_SCALE
+  IF tax_units or vip_discount_units is not a whole number THEN
+    THROW error "Rate not representable"        // cannot happen with RATE_SCALE derived above
+  END IF
+
+  IF carts is empty THEN
+    RETURN five empty arrays                    // NumPy max of an empty array would raise
+  END IF
+
+  // Largest subtotal whose scaled total still fits in int64, using the largest multiplier
+  // actually applied (tax raises it above RATE_SCALE) and the fee and rounding terms.
+  // Computed with Python integers, which cannot overflow
+  SET max_multiplier = max(RATE_SCALE + tax_units, RATE_SCALE - vip_discount_units + tax_units)
+  SET max_fee_term = (BASE_DELIVERY_FEE as Decimal × 100) × RATE_SCALE
+  SET subtotal_limit = (INT64_MAX - max_fee_term - RATE_SCALE / 2) // max_multiplier
+
+  SET item_map = load cart menu items for all cart items of all carts        // one query
+  SET item_ids = sorted array of item_map keys
+  // Convert through Decimal so 12.99 becomes exactly 1299 cents, not a truncated float
+  SET price_cents = int64 array of (item_map price as Decimal × 100), in item_ids order
+
+  FLATTEN carts into parallel arrays:
+    cart_index (int64, which cart each line belongs to)
+    line_item_id (int64)
+    line_quantity (int64)
+
+  SET positions = searchsorted(item_ids, line_item_id)
+  SET found = positions < length of item_ids
+  SET found[found] = item_ids[positions[found]] == line_item_id[found]
+  IF not all of found THEN
+    THROW error "Item not found: " + distinct line_item_id[not found]     // as the scalar path would
+  END IF
+  SET line_price = price_cents[positions]
+
+  // Check before multiplying or accumulating, since int64 overflow in NumPy wraps silently
+  IF any line_quantity > subtotal_limit // max(line_price, 1) THEN
+    THROW error "Cart total too large for bulk pricing"
+  END IF
+  SET line_total = line_price × line_quantity
+  IF line_total is not empty THEN               // every cart may be empty
+    SET max_lines_per_cart = max of bincount(cart_index)
+    IF (max of line_total) × max_lines_per_cart > subtotal_limit THEN     // Python integers
+      THROW error "Cart total too large for bulk pricing"
+    END IF
+  END IF
+
+  // Integer accumulation; bincount with weights would go through float64
+  SET subtotal_cents = int64 zeros, one per cart
+  ADD AT subtotal_cents[cart_index] the values line_total
+
+  SET vip = int64 array of is_vip
+  SET fee_cents = where(is_free_delivery, 0, BASE_DELIVERY_FEE as Decimal × 100)
+
+  SET discount_units = vip × vip_discount_units
+  SET scaled_total = subtotal_cents × (RATE_SCALE - discount_units + tax_units) + fee_cents × RATE_SCALE
+  SET total_cents = (scaled_total + RATE_SCALE / 2) // RATE_SCALE     // round half up to the cent
+
+  SET subtotal = subtotal_cents / 100
+  SET discount = subtotal_cents × discount_units / (100 × RATE_SCALE)
+  SET taxes = subtotal_cents × tax_units / (100 × RATE_SCALE)
+  SET delivery_fee = fee_cents / 100
+  SET total = total_cents / 100
+  RETURN subtotal, discount, taxes, delivery_fee, total
+END
+
+
+Function: benchmark_bulk_pricing
+Input: cart_count (integer), catalog_size (integer)
+Output: carts_per_second (decimal), mismatches (integer)
+
+BEGIN
+  GENERATE cart_count random carts of 1 to 10 lines from catalog_size items, with random is_vip and is_free_delivery
+
+  START timer
+  PRICE carts bulk
+  SET elapsed = timer elapsed seconds
+
+  // Cross-check a sample against the scalar function
+  SET mismatches = 0
+  FOR EACH cart IN 10000 randomly sampled carts DO
+    IF calculate order total for cart does not equal bulk total for cart THEN
+      INCREMENT mismatches by 1
+    END IF
+  END FOR
+
+  RETURN cart_count / elapsed, mismatches
+END
+
+
+Function: load_cart_menu_items
+Input: cart_items (list)
+Output: item map (map of item_id to menu item)
+
+BEGIN
+  SET item_ids = distinct item_ids of cart_items
+  FETCH item_id, price, is_available, is_vip_only of menu items WHERE item_id IN item_ids   // one query
+  CREATE item map from fetched rows keyed by item_id
+  RETURN item map
 END
 
 
-Function: calculate_order_total
-Input: cart_items (list), is_vip (boolean), is_free_delivery (boolean)
-Output: total (decimal)
+Function: benchmark_order_queries
+Input: cart_sizes (list of integer), orders_per_size (integer)
+Output: report (list of cart size, queries per order, orders per second)
 
 BEGIN
-  SET subtotal = 0
-
-  FOR EACH cart_item IN cart_items DO
-    FETCH menu item by cart_item's item_id
-    INCREMENT subtotal by (item price × cart_item quantity)
+  CREATE empty report
+  FOR EACH size IN cart_sizes DO
+    RESET database query counter
+    START timer
+    REPEAT orders_per_size times
+      PLACE order for a funded test customer with size distinct available items
+    END REPEAT
+    SET elapsed = timer elapsed seconds
+    ADD (size, database query counter / orders_per_size, orders_per_size / elapsed) to report
   END FOR
+  RETURN report
+END
 
-  IF is_vip THEN
-    SET discount = subtotal × 0.05
-  ELSE
-    SET discount = 0
-  END IF
 
-  SET taxes = subtotal × TAX_RATE
+Function: run_order_load_test
+Input: customer_count (integer), concurrency (integer), duration_seconds (integer), cart_size (integer)
+Output: orders_per_second (decimal), p50 latency, p99 latency, failed_count (integer)
 
-  IF is_free_delivery THEN
-    SET delivery_fee = 0
-  ELSE
-    SET delivery_fee = BASE_DELIVERY_FEE
-  END IF
+BEGIN
+  CREATE customer_count active test customers with large balances
+  CREATE empty latency list
+  SET failed_count = 0
+
+  START timer
+  RUN concurrency workers until duration_seconds have passed, each repeatedly:
+    PICK a random test customer
+    START request timer
+    PLACE order for the customer with cart_size random available items
+    ADD elapsed request time to latency list
+    IF order was not placed THEN
+      INCREMENT failed_count by 1
+    END IF
+  SET elapsed = timer elapsed seconds
 
-  SET total = subtotal - discount + taxes + delivery_fee
-  ROUND total to 2 decimal places
-  RETURN total
+  SET placed = size of latency list - failed_count
+  RETURN placed / elapsed, 50th percentile of latency list, 99th percentile of latency list, failed_count
 END
 
 
@@ -431,12 +2185,111 @@ BEGIN
   SET order status = "AWAITING_BIDS"
   SAVE order to database
 
-  FETCH all available delivery persons
-  FOR EACH delivery_person IN available delivery persons DO
-    SEND notification to delivery_person about new order
+  GET available delivery persons from delivery registry
+  DISPATCH notification about new order to available delivery persons with dedup key "NEW_ORDER:" + order_id
+
+  OPEN bidding window for order_id closing at CLOCK now + BIDDING_WINDOW_DURATION
+END
+
+
+Function: dispatch_notifications
+Input: recipient_ids (list of integer), message (string), dedup_key (string)
+Output: none
+
+BEGIN
+  // Only enqueues; sending happens on the notification workers, off the request path
+  FOR EACH batch IN recipient_ids split into chunks of NOTIFICATION_BATCH_SIZE DO
+    PUT (batch, message, dedup_key, attempt = 1) on notification queue
+  END FOR
+END
+
+
+Function: run_notification_sender
+Input: worker_count (integer)
+Output: none
+
+BEGIN
+  START worker_count async tasks, each:
+    WHILE notification queue is not shutting down DO
+      AWAIT next (batch, message, dedup_key, attempt) from notification queue
+
+      // Reserve before sending: check-and-add is one step with no await in between, so two
+      // workers holding the same (recipient, dedup_key) cannot both send it
+      CREATE empty pending list
+      FOR EACH recipient IN batch DO
+        IF (recipient, dedup_key) is not in sent keys AND not in in_flight keys THEN
+          ADD (recipient, dedup_key) to in_flight keys
+          ADD recipient to pending
+        END IF
+      END FOR
+      IF pending is empty THEN
+        SKIP to next batch
+      END IF
+
+      TRY
+        AWAIT SEND message to pending recipients as one batch request to NOTIFICATION_SINK
+      CATCH timeout or sink error
+        MARK delivery to every recipient in pending as failed
+        LOG "Notification batch failed" with dedup_key and error
+      END TRY
+
+      FOR EACH recipient IN pending DO
+        REMOVE (recipient, dedup_key) from in_flight keys    // released on failure so a retry can send
+        IF delivery to recipient succeeded THEN
+          ADD (recipient, dedup_key) to sent keys with expiry NOTIFICATION_DEDUP_TTL
+          INCREMENT notifications sent by 1
+        ELSE IF attempt < NOTIFICATION_MAX_ATTEMPTS THEN
+          // Per-recipient retry: only the failures are re-queued, after a backoff
+          SCHEDULE put of ([recipient], message, dedup_key, attempt + 1) on notification queue
+            after NOTIFICATION_RETRY_DELAY × 2 ^ (attempt - 1) plus random jitter
+        ELSE
+          INCREMENT notifications failed by 1
+          LOG "Notification failed" with recipient and dedup_key
+        END IF
+      END FOR
+    END WHILE
+END
+
+
+Function: run_fake_notification_sink
+Input: failure_rate (decimal), latency_seconds (decimal)
+Output: none
+
+BEGIN
+  LISTEN for batch send requests
+  FOR EACH request DO
+    AWAIT sleep latency_seconds
+    FOR EACH recipient IN request DO
+      IF random number < failure_rate THEN
+        MARK recipient as failed in the response
+      ELSE
+        ADD (recipient, message) to sink received list
+      END IF
+    END FOR
+    RETURN per-recipient results
+  END FOR
+END
+
+
+Function: benchmark_notification_fanout
+Input: recipient_count (integer), order_count (integer), worker_count (integer)
+Output: notifications_per_second (decimal), duplicate_count (integer), failed_count (integer)
+
+BEGIN
+  START fake notification sink with failure_rate 0.05 and latency_seconds 0.02
+  SET NOTIFICATION_SINK = the fake notification sink
+  START notification sender with worker_count workers
+
+  START timer
+  FOR order_id FROM 1 TO order_count DO
+    DISPATCH notifications to recipient_count recipients with dedup key "NEW_ORDER:" + order_id
+    DISPATCH the same notifications again          // must be deduplicated
   END FOR
+  WAIT until notification queue is empty and no retries are scheduled
+  SET elapsed = timer elapsed seconds
 
-  OPEN bidding window for order_id with 5 minute duration
+  SET duplicate_count = number of (recipient, message) pairs received more than once by the sink
+  RETURN notifications sent / elapsed, duplicate_count, notifications failed
 END
 
 
@@ -445,8 +2298,7 @@ Input: delivery_person_id (integer), order_id (integer), bid_amount (decimal), e
 Output: success (boolean), message (string)
 
 BEGIN
-  CHECK if bidding window is still open for order_id
-  IF bidding window is closed THEN
+  IF bidding window for order_id is not open THEN
     RETURN FALSE, "Window closed"
   END IF
 
@@ -462,11 +2314,15 @@ BEGIN
   SET bid eta_minutes = eta_minutes
   SET bid created_at = current timestamp
   SET bid is_selected = FALSE
-  SAVE bid to database
 
-  COUNT total bids for this order
+  GET bid book for order_id
+  ADD bid to bid book, returning added and bid count
+  IF not added THEN
+    RETURN FALSE, "Window closed"
+  END IF
+
   IF bid count >= 3 THEN
-    CLOSE bidding window for order_id
+    CLOSE bidding window for order_id        // runs close_bidding at most once
   END IF
 
   RETURN TRUE, "Bid ok"
@@ -478,15 +2334,338 @@ Input: order_id (integer)
 Output: none
 
 BEGIN
-  CLOSE bidding window for order_id
-  FETCH all bids for order_id
+  // Called only by close_bidding_window, once per order
+  GET bid book for order_id
+  FLUSH bid book for order_id
 
-  IF no bids exist THEN
+  IF bid book count = 0 THEN
     RETURN
   END IF
 
-  SORT bids by bid_amount (ascending)
-  NOTIFY manager with sorted bid list for order_id
+  NOTIFY manager with bid book sorted list for order_id
+END
+
+
+Function: get_bid_book
+Input: order_id (integer)
+Output: bid book
+
+BEGIN
+  // Books live in BID_BOOK_STORE, an in-memory store shared by every application process,
+  // so a bid accepted by any worker lands in the same book. Each book is:
+  //   bids    sorted set of bids scored by (bid_amount, eta_minutes, arrival sequence)
+  //   closed  flag set once, when the window closes
+  //   by_id   map of bid_id to bid, filled when the book is flushed
+  SET book = handle for key "bid_book:" + order_id in BID_BOOK_STORE
+
+  // Missing from the store after it was cleared: only flushed bids exist, so rebuild a closed book
+  IF book does not exist in BID_BOOK_STORE AND bidding window for order_id is not open THEN
+    FETCH all bids for order_id
+    IN ONE ATOMIC STORE OPERATION:
+      ADD every fetched bid to book bids and book by_id
+      SET book closed = TRUE
+  END IF
+
+  RETURN book
+END
+
+
+Function: bid_book_add
+Input: book (bid book), bid (delivery bid)
+Output: added (boolean), count (integer)
+
+BEGIN
+  // One atomic store operation, so concurrent bids from any process cannot interleave
+  // between the closed check, the insert and the count
+  IN ONE ATOMIC STORE OPERATION:
+    IF book closed THEN
+      RETURN FALSE, size of book bids
+    END IF
+    SET arrival = increment of book arrival counter
+    ADD bid with arrival to book bids scored by (bid bid_amount, bid eta_minutes, arrival)   // O(log n)
+    RETURN TRUE, size of book bids                                                      // O(1)
+END
+
+
+Function: bid_book_count
+Input: book (bid book)
+Output: count (integer)
+
+BEGIN
+  RETURN size of book bids                            // O(1)
+END
+
+
+Function: bid_book_lowest
+Input: book (bid book)
+Output: bid or NULL
+
+BEGIN
+  IF size of book bids = 0 THEN
+    RETURN NULL
+  END IF
+  RETURN first entry of book bids by score            // O(log n)
+END
+
+
+Function: bid_book_sorted_list
+Input: book (bid book)
+Output: list of bids
+
+BEGIN
+  RETURN all entries of book bids in score order      // already ordered, no sort needed
+END
+
+
+Function: flush_bid_book
+Input: book (bid book), order_id (integer)
+Output: none
+
+BEGIN
+  SET book closed = TRUE                              // atomic; later submit_bid calls are rejected
+
+  // Safe to repeat after a crash mid-close: rows are keyed by (order_id, arrival)
+  IF size of book bids > 0 THEN
+    INSERT all bids in book into delivery bids in one bulk statement
+      ON CONFLICT (order_id, arrival) DO NOTHING
+    FETCH bid_id, arrival of delivery bids for order_id
+    SET book by_id from the fetched rows, matched to book bids by arrival
+  END IF
+END
+
+
+Function: open_bidding_window
+Input: order_id (integer), closes_at (timestamp)
+Output: none
+
+BEGIN
+  CREATE new bidding window
+  SET window order_id = order_id
+  SET window closes_at = closes_at
+  SET window status = "OPEN"
+  SAVE window to database                      // lets windows survive a restart
+
+  SET open_windows[order_id] = closes_at
+  SCHEDULE timer for order_id at closes_at on the timer wheel
+END
+
+
+Function: is_bidding_window_open
+Input: order_id (integer)
+Output: open (boolean)
+
+BEGIN
+  IF order_id in open_windows THEN
+    RETURN CLOCK now < open_windows[order_id]
+  END IF
+
+  // Opened by another process: the persisted row is the source of truth
+  FETCH bidding window by order_id
+  IF window not found THEN
+    RETURN FALSE
+  END IF
+  RETURN window status = "OPEN" AND CLOCK now < window closes_at
+END
+
+
+Function: close_bidding_window
+Input: order_id (integer)
+Output: none
+
+BEGIN
+  // The conditional update is the single point that decides who closes the window,
+  // whether the timer, the third bid or another process gets there first
+  UPDATE bidding window WHERE order_id = order_id AND status = "OPEN":
+    SET status = "CLOSING"
+    SET closing_started_at = CLOCK now
+  DELETE open_windows[order_id]
+  CANCEL timer for order_id on the timer wheel
+  PUBLISH window closed for order_id to the other application processes   // they drop it from open_windows
+
+  IF one row was updated THEN
+    FINISH bidding close for order_id
+  END IF
+END
+
+
+Function: finish_bidding_close
+Input: order_id (integer)
+Output: none
+
+BEGIN
+  // CLOSED is recorded only after close_bidding returns; a crash in between leaves the
+  // row CLOSING and rehydrate_bidding_windows runs close_bidding again, so close_bidding
+  // must tolerate a repeat of a partially completed run
+  CLOSE bidding for order_id
+  UPDATE bidding window SET status = "CLOSED" WHERE order_id = order_id AND status = "CLOSING"
+END
+
+
+Function: timer_wheel_schedule
+Input: order_id (integer), expires_at (timestamp)
+Output: none
+
+BEGIN
+  // TIMER_WHEEL_LEVELS levels of TIMER_WHEEL_SLOTS slots; a slot at level L spans
+  // TIMER_WHEEL_SLOTS ^ L ticks of TIMER_TICK seconds
+  SET ticks = max(1, ceiling((expires_at - wheel current_time) / TIMER_TICK))
+  SET target_tick = wheel current_tick + ticks
+
+  CREATE new timer with order_id, expires_at, target_tick
+  PLACE timer on the timer wheel
+  SET wheel timers[order_id] = timer
+END
+
+
+Function: timer_wheel_place
+Input: timer (timer)
+Output: none
+
+BEGIN
+  // Used for new timers and for timers cascaded down from a higher level. A cascaded timer
+  // can be due on the current tick (ticks = 0); it then lands in the level-0 slot that
+  // advance_timer_wheel processes next in the same iteration
+  SET ticks = max(0, timer target_tick - wheel current_tick)
+
+  SET level = 0
+  WHILE ticks >= TIMER_WHEEL_SLOTS ^ (level + 1) AND level < TIMER_WHEEL_LEVELS - 1 DO
+    INCREMENT level by 1
+  END WHILE
+  SET slot = (timer target_tick / TIMER_WHEEL_SLOTS ^ level, rounded down) mod TIMER_WHEEL_SLOTS
+  ADD timer to wheel levels[level] slots[slot]
+END
+
+
+Function: timer_wheel_cancel
+Input: order_id (integer)
+Output: none
+
+BEGIN
+  IF order_id in wheel timers THEN
+    SET wheel timers[order_id] cancelled = TRUE          // dropped lazily when its slot is reached
+    DELETE wheel timers[order_id]
+  END IF
+END
+
+
+Function: advance_timer_wheel
+Input: now (timestamp)
+Output: none
+
+BEGIN
+  WHILE wheel current_time + TIMER_TICK <= now DO
+    INCREMENT wheel current_tick by 1
+    INCREMENT wheel current_time by TIMER_TICK
+
+    // Cascade: when a lower level wraps, spread the next higher slot back down
+    FOR level FROM 1 TO TIMER_WHEEL_LEVELS - 1 DO
+      IF wheel current_tick mod TIMER_WHEEL_SLOTS ^ level does not equal 0 THEN
+        STOP cascading
+      END IF
+      SET slot = (wheel current_tick / TIMER_WHEEL_SLOTS ^ level, rounded down) mod TIMER_WHEEL_SLOTS
+      FOR EACH timer IN wheel levels[level] slots[slot] that is not cancelled DO
+        PLACE timer on the timer wheel           // by its own target_tick, not re-rounded from expires_at
+      END FOR
+      EMPTY wheel levels[level] slots[slot]
+    END FOR
+
+    SET slot = wheel current_tick mod TIMER_WHEEL_SLOTS
+    SET due = timers in wheel levels[0] slots[slot] that are not cancelled
+    EMPTY wheel levels[0] slots[slot]
+    FOR EACH timer IN due DO
+      DELETE wheel timers[timer order_id]
+      CLOSE bidding window for timer order_id
+    END FOR
+  END WHILE
+END
+
+
+Function: run_bidding_timer
+Input: none
+Output: none
+
+BEGIN
+  // CLOCK is the wall clock in production and a simulated clock in tests
+  SET next_sweep = CLOCK now + BIDDING_SWEEP_INTERVAL
+  WHILE server is running DO
+    WAIT on CLOCK until wheel current_time + TIMER_TICK
+    ADVANCE timer wheel to CLOCK now
+    IF CLOCK now >= next_sweep THEN
+      // Windows whose owning process exited have no timer on any live wheel
+      CLAIM overdue bidding windows
+      SET next_sweep = CLOCK now + BIDDING_SWEEP_INTERVAL
+    END IF
+  END WHILE
+END
+
+
+Function: rehydrate_bidding_windows
+Input: none
+Output: none
+
+BEGIN
+  SET wheel current_time = CLOCK now
+  SET wheel current_tick = 0
+
+  CLAIM overdue bidding windows
+
+  FETCH all bidding windows WHERE status = "OPEN"
+  FOR EACH window IN bidding windows DO
+    IF window closes_at <= CLOCK now THEN
+      CLOSE bidding window for window order_id       // expired while we were down
+    ELSE
+      SET open_windows[window order_id] = window closes_at
+      SCHEDULE timer for window order_id at window closes_at on the timer wheel
+    END IF
+  END FOR
+END
+
+
+Function: claim_overdue_bidding_windows
+Input: none
+Output: none
+
+BEGIN
+  // Run at startup and every BIDDING_SWEEP_INTERVAL by each live process.
+  // Closes interrupted by a crash; the lease keeps live processes from finishing the same one
+  FETCH all bidding windows WHERE status = "CLOSING"
+    AND closing_started_at < CLOCK now - BIDDING_CLOSE_LEASE
+  FOR EACH window IN bidding windows DO
+    UPDATE bidding window WHERE order_id = window order_id AND status = "CLOSING"
+        AND closing_started_at = window closing_started_at:
+      SET closing_started_at = CLOCK now
+    IF one row was updated THEN
+      FINISH bidding close for window order_id
+    END IF
+  END FOR
+
+  // Windows still OPEN a full lease past closes_at: the owning timer is gone. The grace
+  // period leaves normal closes to the owner, and close_bidding_window's conditional
+  // update lets only one process win
+  FETCH all bidding windows WHERE status = "OPEN" AND closes_at < CLOCK now - BIDDING_CLOSE_LEASE
+  FOR EACH window IN bidding windows DO
+    CLOSE bidding window for window order_id
+  END FOR
+END
+
+
+Function: simulate_bidding_windows
+Input: order_count (integer)
+Output: passed (boolean)
+
+BEGIN
+  SET CLOCK = simulated clock starting at a fixed timestamp
+  REPLACE close_bidding with a recorder that counts calls per order_id
+
+  OPEN bidding for order_count orders, spreading their start times over 10 simulated minutes
+  SUBMIT 3 bids to every fifth order so it closes on the third bid
+  RESTART the bidding timer halfway through and rehydrate bidding windows
+  ADVANCE simulated clock and the timer wheel one second at a time until 20 minutes have passed
+
+  SET passed = every order was closed exactly once
+               AND each timer-closed order closed within one TIMER_TICK after its closes_at
+               AND no order closed before its closes_at unless it received 3 bids
+  RETURN passed
 END
 
 
@@ -501,17 +2680,23 @@ BEGIN
     THROW error "No permission"
   END IF
 
-  FETCH all bids for order_id
+  GET bid book for order_id
+  IF bid book is not closed THEN
+    THROW error "Bidding still open"            // bid ids exist only once the book is flushed
+  END IF
 
-  IF no bids exist THEN
-    FETCH any available delivery person
+  IF bid book count = 0 THEN
+    SELECT fallback delivery person from delivery registry
     IF no delivery person available THEN
       THROW error "No delivery person"
     END IF
     SET selected_delivery_id = delivery person's delivery_id
   ELSE
-    FETCH selected bid by selected_bid_id
-    FIND lowest bid from all bids
+    IF selected_bid_id is NULL OR selected_bid_id not in bid book by_id THEN
+      THROW error "Bid not found"
+    END IF
+    SET selected bid = bid book by_id[selected_bid_id]
+    SET lowest bid = bid book lowest
 
     IF selected bid amount > lowest bid amount THEN
       IF memo_text is NULL OR memo_text is empty THEN
@@ -535,38 +2720,259 @@ BEGIN
   SET order delivery_id = selected_delivery_id
   SET order status = "READY_FOR_DELIVERY"
   SAVE order to database
+  UPDATE delivery registry for selected_delivery_id: SET load = load + 1
+  PUBLISH delivery registry change for selected_delivery_id to the other application processes
 
-  IF bids exist THEN
+  IF bid book count > 0 THEN
     SET selected bid is_selected = TRUE
     SAVE selected bid to database
   END IF
-END
 
+  DELETE bid book for order_id from BID_BOOK_STORE
+END
+
+
+
+Function: update_order_status
+Input: delivery_person_id (integer), order_id (integer), new_status (string)
+Output: none
+
+BEGIN
+  FETCH order by order_id
+  IF order's delivery_id does not equal delivery_person_id THEN
+    THROW error "Not assigned"
+  END IF
+
+  SET was_out = order status equals "OUT_FOR_DELIVERY"
+
+  IF new_status equals "OUT_FOR_DELIVERY" THEN
+    SET order status = "OUT_FOR_DELIVERY"
+    SET order picked_up_at = current timestamp
+    SAVE order to database
+    IF was_out is FALSE THEN
+      UPDATE delivery registry for delivery_person_id: SET out_count = out_count + 1
+      PUBLISH delivery registry change for delivery_person_id to the other application processes
+    END IF
+  ELSE IF new_status equals "DELIVERED" THEN
+    SET order status = "DELIVERED"
+    SET order delivered_at = current timestamp
+    SAVE order to database
+
+    FETCH delivery person by delivery_person_id
+    INCREMENT delivery person balance by order's delivery_price
+    SAVE delivery person to database
+
+    UPDATE delivery registry for delivery_person_id:
+      SET load = load - 1
+      SET out_count = out_count - 1 if was_out, else unchanged
+    PUBLISH delivery registry change for delivery_person_id to the other application processes
+  END IF
+END
+
+
+Function: rebuild_delivery_registry
+Input: none
+Output: none
+
+BEGIN
+  CREATE new delivery registry
+  SET registry people = empty map of delivery_id to (on_shift, load, out_count, rating)
+  SET registry status_of = empty map of delivery_id to status
+  SET registry by_status = map of "AVAILABLE", "ON_DELIVERY", "OFF_SHIFT" to empty sets of delivery_id
+  SET registry available_by_load = empty map of load to set of delivery_id
+  SET registry available_by_rating = empty sorted list of (rating, delivery_id)
+
+  // Every process keeps its own registry. Changes made by other processes arrive as
+  // delivery_ids; subscribing before the fetch means none published meanwhile is missed.
+  // Ids that arrive during the rebuild are held back and reloaded into the new registry
+  SET delivery registry pending_reloads = empty set
+  IF this process is not subscribed to delivery registry changes THEN
+    SUBSCRIBE to published delivery registry changes:
+      ACQUIRE delivery registry lock
+      SET held = delivery registry pending_reloads is set
+      IF held THEN
+        ADD delivery_id to delivery registry pending_reloads
+      END IF
+      RELEASE delivery registry lock
+      IF held is FALSE THEN
+        RELOAD delivery registry entry for delivery_id
+      END IF
+  END IF
+
+  FETCH all delivery persons whose employment_status is not "FIRED"
+  FETCH per delivery_id COUNT of orders WHERE status = "READY_FOR_DELIVERY" or "OUT_FOR_DELIVERY",
+    and COUNT of those WHERE status = "OUT_FOR_DELIVERY"
+  FOR EACH delivery_person IN delivery persons DO
+    UPDATE new delivery registry for delivery_id, creating the entry:
+      SET on_shift = delivery person on_shift
+      SET load = count of their assigned, undelivered orders
+      SET out_count = count of their orders out for delivery
+      SET rating = delivery person avg_rating
+  END FOR
+
+  ACQUIRE delivery registry lock                        // the subscriber checks pending_reloads under it too
+  REPLACE current delivery registry with the new registry
+  SET pending = delivery registry pending_reloads
+  SET delivery registry pending_reloads = NULL          // later ids are reloaded directly
+  RELEASE delivery registry lock
+  FOR EACH delivery_id IN pending DO
+    RELOAD delivery registry entry for delivery_id
+  END FOR
+END
+
+
+Function: reload_delivery_registry_entry
+Input: delivery_id (integer)
+Output: none
+
+BEGIN
+  // Rebuilds one entry from the database row, so it is correct however many published
+  // changes arrive, and in whatever order
+  FETCH delivery person by delivery_id
+  IF delivery person not found OR delivery person employment_status equals "FIRED" THEN
+    REMOVE delivery_id from delivery registry
+    RETURN
+  END IF
+
+  FETCH COUNT of orders for delivery_id WHERE status = "READY_FOR_DELIVERY" or "OUT_FOR_DELIVERY",
+    and COUNT of those WHERE status = "OUT_FOR_DELIVERY"
+  UPDATE delivery registry for delivery_id, creating the entry:
+    SET on_shift = delivery person on_shift
+    SET load = count of their assigned, undelivered orders
+    SET out_count = count of their orders out for delivery
+    SET rating = delivery person avg_rating
+END
+
+
+Function: update_delivery_registry
+Input: delivery_id (integer), changes (field updates to on_shift, load, out_count or rating), create (boolean, TRUE only for calls "creating the entry")
+Output: none
+
+BEGIN
+  // The whole read-modify-write happens under one lock, so concurrent assign, pick-up
+  // and delivery calls cannot lose updates or leave a stale index entry behind
+  ACQUIRE delivery registry lock
+
+  IF delivery_id not in registry people THEN
+    IF create is FALSE THEN
+      // Unknown ids are fired or not loaded yet; a delta (e.g. a late delivery or rating)
+      // must never bring them back as available
+      RELEASE delivery registry lock
+      RETURN
+    END IF
+    // Only rebuild and reload create entries, and they set every field from the database row
+    SET registry people[delivery_id] = (on_shift = FALSE, load = 0, out_count = 0, rating = DEFAULT_DELIVERY_RATING)
+  END IF
+  SET person = registry people[delivery_id]
+
+  // Take the person out of the indexes under their old values
+  IF delivery_id in registry status_of THEN
+    REMOVE delivery_id from registry by_status[registry status_of[delivery_id]]
+    IF registry status_of[delivery_id] equals "AVAILABLE" THEN
+      REMOVE delivery_id from registry available_by_load[person load]
+      DELETE (person rating, delivery_id) from registry available_by_rating (bisection)
+    END IF
+  END IF
+
+  APPLY changes to person
+  IF person rating is NULL THEN
+    SET person rating = DEFAULT_DELIVERY_RATING       // not rated yet
+  END IF
+  SET person load = max(0, person load)
+  SET person out_count = max(0, person out_count)
+
+  // Status follows from the shift flag and deliveries in progress, so a delivery finishing
+  // never marks someone who went off shift as available
+  IF person on_shift is FALSE THEN
+    SET status = "OFF_SHIFT"
+  ELSE IF person out_count > 0 THEN
+    SET status = "ON_DELIVERY"
+  ELSE
+    SET status = "AVAILABLE"
+  END IF
+
+  SET registry status_of[delivery_id] = status
+  ADD delivery_id to registry by_status[status]
+  IF status equals "AVAILABLE" THEN
+    ADD delivery_id to registry available_by_load[person load]
+    INSERT (person rating, delivery_id) into registry available_by_rating (bisection)
+  END IF
+
+  RELEASE delivery registry lock
+END
 
 
-Function: update_order_status
-Input: delivery_person_id (integer), order_id (integer), new_status (string)
+Function: remove_from_delivery_registry
+Input: delivery_id (integer)
 Output: none
 
 BEGIN
-  FETCH order by order_id
-  IF order's delivery_id does not equal delivery_person_id THEN
-    THROW error "Not assigned"
+  ACQUIRE delivery registry lock
+  IF delivery_id in registry status_of THEN
+    SET person = registry people[delivery_id]
+    REMOVE delivery_id from registry by_status[registry status_of[delivery_id]]
+    IF registry status_of[delivery_id] equals "AVAILABLE" THEN
+      REMOVE delivery_id from registry available_by_load[person load]
+      DELETE (person rating, delivery_id) from registry available_by_rating (bisection)
+    END IF
+    DELETE registry status_of[delivery_id]
   END IF
+  DELETE registry people[delivery_id]
+  RELEASE delivery registry lock
+END
 
-  IF new_status equals "OUT_FOR_DELIVERY" THEN
-    SET order status = "OUT_FOR_DELIVERY"
-    SET order picked_up_at = current timestamp
-    SAVE order to database
-  ELSE IF new_status equals "DELIVERED" THEN
-    SET order status = "DELIVERED"
-    SET order delivered_at = current timestamp
-    SAVE order to database
 
-    FETCH delivery person by delivery_person_id
-    INCREMENT delivery person balance by order's delivery_price
-    SAVE delivery person to database
+Function: set_delivery_shift
+Input: delivery_id (integer), on_shift (boolean)
+Output: none
+
+BEGIN
+  FETCH delivery person by delivery_id
+  SET delivery person on_shift = on_shift
+  SAVE delivery person to database
+
+  // May be the first time this person enters the registry, so load them from their row
+  RELOAD delivery registry entry for delivery_id
+  PUBLISH delivery registry change for delivery_id to the other application processes
+END
+
+
+Function: get_available_delivery_persons
+Input: none
+Output: set of delivery_id
+
+BEGIN
+  // A copy taken under the lock; callers iterate it while other threads change the registry
+  ACQUIRE delivery registry lock
+  SET available = copy of registry by_status["AVAILABLE"]
+  RELEASE delivery registry lock
+  RETURN available
+END
+
+
+Function: select_fallback_delivery_person
+Input: none
+Output: delivery_id (integer or NULL)
+
+BEGIN
+  ACQUIRE delivery registry lock
+  IF registry by_status["AVAILABLE"] is empty THEN
+    RELEASE delivery registry lock
+    RETURN NULL
   END IF
+
+  IF DELIVERY_FALLBACK_POLICY equals "BEST_RATED" THEN
+    SET selected = delivery_id of the last entry in registry available_by_rating
+  ELSE
+    // "LEAST_LOADED": loads are small integers, so scanning up from 0 stops almost immediately
+    SET load = 0
+    WHILE registry available_by_load[load] is empty DO
+      INCREMENT load by 1
+    END WHILE
+    SET selected = any delivery_id in registry available_by_load[load]
+  END IF
+  RELEASE delivery registry lock
+  RETURN selected
 END
 
 
@@ -614,7 +3020,7 @@ BEGIN
   SET rating created_at = current timestamp
   SAVE rating to database
 
-  UPDATE employee statistics after rating for order_id
+  ENQUEUE job "RATING_STATS" with order_id
   RETURN TRUE, "Thanks"
 END
 
@@ -627,34 +3033,217 @@ BEGIN
   FETCH order by order_id
   FETCH rating by order_id
 
-  FETCH all order items for order_id
-  FOR EACH order_item IN order items DO
-    FETCH menu item by order_item's item_id
-    FETCH chef by menu item's chef_id
-    FETCH all ratings for this chef
-    CALCULATE weighted average of food ratings
-    SET chef avg_rating = calculated average
-    SET chef rating_count = count of ratings
-    SAVE chef to database
-  END FOR
-
-  FETCH delivery person by order's delivery_id
-  FETCH all ratings for this delivery person
-  CALCULATE weighted average of delivery ratings
-  SET delivery person avg_rating = calculated average
-  SET delivery person rating_count = count of ratings
-  SAVE delivery person to database
+  SET food_points = rating food_rating × rating weight
+  SET delivery_points = rating delivery_rating × rating weight
+
+  FETCH item_id and chef_id of all order items for order_id (order items JOIN menu items)
+  SET item ids = distinct item_ids of order items
+  SET chef ids = distinct chef_ids of order items   // a chef with several dishes counts once per rating
+
+  BEGIN database transaction
+
+  // Jobs can be replayed after a restart; the flag makes the increments apply once
+  UPDATE rating SET stats_applied = TRUE WHERE rating_id = rating rating_id AND stats_applied = FALSE
+  IF no row was updated THEN
+    ROLLBACK database transaction
+    RETURN
+  END IF
+
+  FOR EACH item_id IN item ids DO
+    UPDATE menu item WHERE item_id = item_id:
+      SET rating_sum = rating_sum + food_points
+      SET rating_weight = rating_weight + rating weight
+      SET avg_rating = (rating_sum + food_points) / (rating_weight + rating weight)
+  END FOR
+
+  FOR EACH chef_id IN chef ids DO
+    UPDATE chef WHERE chef_id = chef_id:
+      SET weighted_rating_sum = weighted_rating_sum + food_points
+      SET rating_weight = rating_weight + rating weight
+      SET rating_count = rating_count + 1
+      SET avg_rating = (weighted_rating_sum + food_points) / (rating_weight + rating weight)
+  END FOR
+
+  UPDATE delivery person WHERE delivery_id = order's delivery_id:
+    SET weighted_rating_sum = weighted_rating_sum + delivery_points
+    SET rating_weight = rating_weight + rating weight
+    SET rating_count = rating_count + 1
+    SET avg_rating = (weighted_rating_sum + delivery_points) / (rating_weight + rating weight)
+  RETURNING avg_rating
+
+  IF rating food_rating = 1 AND rating delivery_rating = 1 THEN
+    UPDATE customer WHERE customer_id = rating rater_id:
+      SET abuse_count = abuse_count + 1
+    RETURNING abuse_count
+  END IF
+
+  COMMIT database transaction
+
+  FOR EACH item_id IN item ids DO
+    REFRESH menu snapshot for item_id          // moves the item within the top-rated leaderboard
+  END FOR
+  UPDATE delivery registry for order's delivery_id: SET rating = the returned avg_rating
+  PUBLISH delivery registry change for order's delivery_id to the other application processes
+
+  IF abuse_count was incremented AND abuse_count > ABUSE_THRESHOLD THEN
+    ENQUEUE job "ABUSE_FLAG" with rating rater_id
+  END IF
+
+  ENQUEUE job "EVALUATE_EMPLOYEE" with order's delivery_id
+END
+
+
+Function: enqueue_job
+Input: job_type (string), payload (value)
+Output: job_id (integer)
+
+BEGIN
+  CREATE new job
+  SET job job_id = next job sequence number
+  SET job job_type = job_type
+  SET job payload = payload
+  SET job attempts = 0
+  SET job enqueued_at = current timestamp
+
+  // Journal first so an accepted job survives a crash or restart
+  APPEND ("ENQUEUED", job) to job journal file
+  FLUSH and FSYNC job journal file
+
+  PUSH job onto job queue
+  RETURN job job_id
+END
+
+
+Function: run_job_worker
+Input: none
+Output: none
+
+BEGIN
+  WHILE job queue is not shutting down DO
+    POP next job from job queue (block while empty)
+    SET started = current timestamp
+
+    TRY
+      // Each job is its own unit of work, like a request
+      IF job job_type equals "RATING_STATS" THEN
+        RUN update employee statistics after rating for job payload in unit of work
+      ELSE IF job job_type equals "ABUSE_FLAG" THEN
+        RUN flag rater for abuse for job payload in unit of work
+      ELSE IF job job_type equals "EVALUATE_EMPLOYEE" THEN
+        RUN evaluate employee performance for job payload in unit of work
+      END IF
+      APPEND ("DONE", job job_id) to job journal file
+      RECORD job latency (current timestamp - started) and lag (started - job enqueued_at) for job job_type
+    CATCH error
+      INCREMENT job attempts by 1
+      IF job attempts < JOB_MAX_ATTEMPTS THEN
+        PUSH job onto job queue after JOB_RETRY_DELAY × 2 ^ (job attempts - 1)
+      ELSE
+        APPEND ("FAILED", job job_id, error) to job journal file
+        LOG "Job failed" with job and error
+      END IF
+    END TRY
+  END WHILE
+END
+
+
+Function: start_job_queue
+Input: worker_count (integer)
+Output: none
+
+BEGIN
+  // Rehydrate jobs that were accepted but not finished before the last shutdown
+  READ job journal file
+  SET pending = jobs with an "ENQUEUED" record and no "DONE" or "FAILED" record
+  FOR EACH job IN pending ordered by job_id DO
+    PUSH job onto job queue
+  END FOR
+
+  REWRITE job journal file with only the pending jobs    // compaction
+  START worker_count job workers
+END
+
 
-  FETCH all ratings by this rater_id
-  COUNT ratings where food_rating = 1 AND delivery_rating = 1
-  IF abuse count > ABUSE_THRESHOLD THEN
-    FLAG rater for abuse
+Function: get_job_queue_stats
+Input: none
+Output: depth (integer), lag_seconds (decimal), latency_by_type (map of job_type to p50 and p99)
+
+BEGIN
+  SET depth = number of jobs in job queue
+  IF depth = 0 THEN
+    SET lag_seconds = 0
+  ELSE
+    SET lag_seconds = current timestamp - enqueued_at of the oldest job in job queue
   END IF
+  RETURN depth, lag_seconds, recorded job latency percentiles per job_type
+END
+
+
 
-  EVALUATE employee performance for delivery person
+Function: rebuild_menu_item_rating_stats
+Input: none
+Output: none
+
+BEGIN
+  // Backfill for the running item sums kept by update_employee_stats_after_rating;
+  // run once before those sums are first incremented, and any time they are in doubt
+  BEGIN database transaction (READ COMMITTED)
+  LOCK all menu item rows FOR UPDATE          // rating jobs wait, then apply on top of the backfill
+
+  FETCH per item_id SUM(rating_food × weight), SUM(weight) over DISTINCT (rating, item_id) pairs
+    of ratings JOIN order items WHERE ratings stats_applied = TRUE
+  FOR EACH menu item DO
+    IF menu item has rated orders THEN
+      SET menu item rating_sum, rating_weight = grouped totals for the item
+      SET menu item avg_rating = rating_sum / rating_weight
+    ELSE
+      SET menu item rating_sum = 0
+      SET menu item rating_weight = 0
+    END IF
+  END FOR
+
+  COMMIT database transaction
+  BUILD menu snapshot                         // leaderboard reflects the backfilled averages
 END
 
 
+Function: rebuild_employee_rating_stats
+Input: none
+Output: none
+
+BEGIN
+  // Backfill for the running sums kept by update_employee_stats_after_rating.
+  // Only ratings whose RATING_STATS job has run are counted; pending jobs add theirs afterwards
+  BEGIN database transaction (READ COMMITTED)
+  // Same order as the rating job (chefs, delivery persons, customers), so neither can deadlock:
+  // rating jobs wait, then apply on top of the backfill
+  LOCK all chef rows FOR UPDATE
+  LOCK all delivery person rows FOR UPDATE
+  LOCK all customer rows FOR UPDATE
+
+  FOR EACH chef DO
+    SET chef weighted_rating_sum, rating_weight, rating_count from
+      SUM(rating_food × weight), SUM(weight), COUNT(*) over DISTINCT (rating, chef) pairs
+      of ratings JOIN order items JOIN menu items WHERE menu item chef_id = chef chef_id
+      AND ratings stats_applied = TRUE
+    SET chef avg_rating = weighted_rating_sum / rating_weight, or NULL if no ratings
+  END FOR
+
+  FOR EACH delivery person DO
+    SET delivery person weighted_rating_sum, rating_weight, rating_count from
+      SUM(rating_delivery × weight), SUM(weight), COUNT(*) of ratings WHERE deliver_id = delivery_id
+      AND stats_applied = TRUE
+    SET delivery person avg_rating = weighted_rating_sum / rating_weight, or NULL if no ratings
+  END FOR
+
+  FOR EACH customer DO
+    SET customer abuse_count = COUNT of ratings by customer WHERE rating_food = 1 AND rating_delivery = 1
+      AND stats_applied = TRUE
+  END FOR
+
+  COMMIT database transaction
+END
+
 
 Function: file_complaint
 Input: from_user_id (integer), against_user_id (integer), target_type (string), complaint_type (string), description (string), order_id (integer)
@@ -731,6 +3320,184 @@ END
 
 
 
+Function: run_in_unit_of_work
+Input: operation (request handler and its arguments)
+Output: operation result
+
+BEGIN
+  // Request-scoped: every service call made while handling one request shares it.
+  // "open unit of work" is a context variable, so each request task or thread has its own
+  IF a unit of work is open in this context THEN
+    RUN operation                              // nested call joins the outer unit of work
+    RETURN operation result
+  END IF
+
+  // New rows (unit_of_work_add) and field changes (unit_of_work_mark_changed) are written
+  // together at commit, or not at all. A few writes go straight to the database and may
+  // outlive a discarded unit of work, because each is complete and consistent on its own:
+  // balance ledger entries (apply_balance_change keeps balance and ledger together),
+  // session revocations, blacklist entries, published messages and queued jobs.
+  // Code that makes one of these after changing entities flushes the unit of work first,
+  // so the changes it depends on cannot be discarded afterwards
+  CREATE new unit of work
+  SET unit of work entities = empty identity map of (entity type, id) to entity
+  SET unit of work changed = empty map of (entity type, id) to set of field names
+  SET unit of work added = empty list of new entities
+  SET unit of work query_count = 0
+  SET token = SET context variable open unit of work = the new unit of work
+
+  TRY
+    RUN operation
+    COMMIT unit of work
+    RETURN operation result
+  CATCH error
+    DISCARD unit of work changes and added entities
+    THROW error
+  FINALLY
+    RESET context variable open unit of work with token    // restores this context's previous value
+  END TRY
+END
+
+
+Function: dispatch_request
+Input: handler (request handler), arguments (request arguments)
+Output: handler result
+
+BEGIN
+  // Every API request enters here, so handlers such as place_order, add_deposit,
+  // resolve_complaint, submit_order_rating and close_customer_account, and everything
+  // they call (add_warning_to_user, check_warning_threshold, check_vip_upgrade, ...),
+  // share one identity map per request
+  RUN handler with arguments in unit of work
+  RETURN handler result
+END
+
+
+Function: unit_of_work_get
+Input: entity_type (string), entity_id (integer)
+Output: entity or NULL
+
+BEGIN
+  IF no unit of work is open in this context THEN
+    FETCH entity_type by entity_id
+    RETURN fetched entity
+  END IF
+
+  IF (entity_type, entity_id) is in unit of work entities THEN
+    RETURN unit of work entities[(entity_type, entity_id)]     // no query
+  END IF
+
+  FETCH entity_type by entity_id                              // counted in query_count
+  SET unit of work entities[(entity_type, entity_id)] = fetched entity
+  RETURN fetched entity
+END
+
+
+Function: unit_of_work_mark_changed
+Input: entity (user, customer or employee), field_names (list of string)
+Output: none
+
+BEGIN
+  IF no unit of work is open in this context THEN
+    SAVE field_names of entity to database
+    RETURN
+  END IF
+
+  ADD field_names to unit of work changed[(entity type, entity id)]
+END
+
+
+Function: unit_of_work_add
+Input: entity (new row, e.g. a warning)
+Output: none
+
+BEGIN
+  IF no unit of work is open in this context THEN
+    SAVE entity to database
+    RETURN
+  END IF
+
+  ADD entity to unit of work added             // inserted in the same transaction as the changes
+END
+
+
+Function: flush_unit_of_work
+Input: none
+Output: none
+
+BEGIN
+  // Writes what the unit of work holds so far and keeps it open for the rest of the request
+  IF a unit of work is open in this context THEN
+    COMMIT unit of work
+  END IF
+END
+
+
+Function: commit_unit_of_work
+Input: none
+Output: none
+
+BEGIN
+  IF unit of work changed is empty AND unit of work added is empty THEN
+    RETURN
+  END IF
+
+  BEGIN database transaction
+  FOR EACH entity IN unit of work added DO
+    SAVE entity to database
+  END FOR
+  FOR EACH (key, field_names) IN unit of work changed DO
+    SET entity = unit of work entities[key]
+    UPDATE entity's table WHERE id = entity id: SET each field in field_names to entity's current value
+  END FOR
+  COMMIT database transaction
+
+  EMPTY unit of work added
+  EMPTY unit of work changed
+END
+
+
+Function: count_query
+Input: none
+Output: none
+
+BEGIN
+  // Called by the database access layer for every statement it sends
+  INCREMENT database query counter by 1
+  IF a unit of work is open in this context THEN
+    INCREMENT unit of work query_count by 1
+  END IF
+END
+
+
+Function: assert_query_budget
+Input: operation (request handler and its arguments), max_queries (integer)
+Output: query_count (integer)
+
+BEGIN
+  // Called at the top level (not inside a request), so the operation gets its own unit of work
+  RUN operation in unit of work, keeping its final query_count
+  IF query_count > max_queries THEN
+    THROW error "Query budget exceeded: " + query_count + " > " + max_queries
+  END IF
+  RETURN query_count
+END
+
+
+Function: check_query_budgets
+Input: none
+Output: none
+
+BEGIN
+  // Budgets for the paths that used to refetch the same rows
+  CREATE active test customer with a funded balance and no warnings
+  ASSERT query budget of add warning to the customer at ADD_WARNING_QUERY_BUDGET
+    // warning insert + user fetch + customer fetch + one user update
+  ASSERT query budget of place order for the customer with a 3 item cart at PLACE_ORDER_QUERY_BUDGET
+    // customer and user fetched once, shared with check_vip_upgrade
+END
+
+
 Function: add_warning_to_user
 Input: user_id (integer), source (string), reason (string)
 Output: none
@@ -741,11 +3508,11 @@ BEGIN
   SET warning source = source
   SET warning reason = reason
   SET warning created_at = current timestamp
-  SAVE warning to database
+  ADD warning to unit of work                  // written with the warning_count increment, or not at all
 
-  FETCH user by user_id
+  GET user by user_id from unit of work
   INCREMENT user warning_count by 1
-  SAVE user to database
+  MARK user field warning_count changed in unit of work
 
   HANDLE warning added to customer for user_id
   HANDLE warning added to employee for user_id
@@ -757,7 +3524,7 @@ Input: user_id (integer)
 Output: none
 
 BEGIN
-  FETCH user by user_id
+  GET user by user_id from unit of work
 
   IF user role equals "CUSTOMER" AND user warning_count >= 3 THEN
     TERMINATE and BLACKLIST customer for user_id
@@ -773,13 +3540,14 @@ Input: employee_id (integer)
 Output: none
 
 BEGIN
-  FETCH all ratings for employee_id
+  // Running weighted average kept by update_employee_stats_after_rating; no rating scan
+  FETCH avg_rating, rating_weight of the chef or delivery person record for employee_id
 
-  IF no ratings exist THEN
+  IF rating_weight is 0 THEN
     RETURN
   END IF
 
-  CALCULATE weighted average of rating values
+  SET average = avg_rating
   COUNT upheld complaints against employee_id
   COUNT compliments for employee_id
   CALCULATE net_complaints = MAX(complaints - compliments, 0)
@@ -833,6 +3601,8 @@ Input: employee_id (integer), reason (string)
 Output: none
 
 BEGIN
+  // The writes below go straight to the database; commit the warning that led here first
+  FLUSH unit of work
   FETCH employee by employee_id
   SET employee employment_status = "FIRED"
   SAVE employee to database
@@ -840,6 +3610,12 @@ BEGIN
   FETCH user by employee_id
   SET user status = "TERMINATED"
   SAVE user to database
+  REVOKE sessions of employee_id
+
+  IF user role equals "DELIVERY" THEN
+    REMOVE employee_id from delivery registry      // no longer offered orders
+    PUBLISH delivery registry change for employee_id to the other application processes   // they reload and drop them
+  END IF
 
   CREATE new manager memo
   SET memo manager_id = current manager id
@@ -857,8 +3633,8 @@ Input: customer_id (integer)
 Output: none
 
 BEGIN
-  FETCH customer by customer_id
-  FETCH user by customer_id
+  GET customer by customer_id from unit of work
+  GET user by customer_id from unit of work
 
   IF customer is already VIP THEN
     RETURN
@@ -879,7 +3655,7 @@ BEGIN
   IF condition1 OR condition2 THEN
     SET customer is_vip = TRUE
     SET customer vip_activated_at = current timestamp
-    SAVE customer to database
+    MARK customer fields is_vip, vip_activated_at changed in unit of work
   END IF
 END
 
@@ -889,19 +3665,19 @@ Input: user_id (integer)
 Output: none
 
 BEGIN
-  FETCH user by user_id
+  GET user by user_id from unit of work
 
   IF user role is not "CUSTOMER" THEN
     RETURN
   END IF
 
-  FETCH customer by user_id
+  GET customer by user_id from unit of work
 
   IF customer is VIP AND user warning_count >= 2 THEN
     SET customer is_vip = FALSE
-    SAVE customer to database
+    MARK customer field is_vip changed in unit of work
     SET user warning_count = 0
-    SAVE user to database
+    MARK user field warning_count changed in unit of work
   END IF
 
   IF user warning_count >= 3 THEN
@@ -915,18 +3691,20 @@ Input: user_id (integer)
 Output: none
 
 BEGIN
-  FETCH user by user_id
-  FETCH customer by user_id
+  GET user by user_id from unit of work
+  GET customer by user_id from unit of work
 
   IF customer balance > 0 THEN
-    ISSUE refund for customer balance via payment gateway
-    SET customer balance = 0
-    SAVE customer to database
+    REFUND customer balance for user_id         // throws before the status change if it cannot
   END IF
 
   SET user status = "TERMINATED"
   SET user is_blacklisted = TRUE
-  SAVE user to database
+  MARK user fields status, is_blacklisted changed in unit of work
+  // Revocation and the blacklist entry are written directly, so commit the warning, its
+  // count and the status first; a later failure can no longer leave the user ACTIVE
+  FLUSH unit of work
+  REVOKE sessions of user_id
 
   ADD user email and phone to blacklist
 END
@@ -946,13 +3724,12 @@ BEGIN
   FETCH user by customer_id
 
   IF customer balance > 0 THEN
-    ISSUE refund for customer balance via payment gateway
-    SET customer balance = 0
-    SAVE customer to database
+    REFUND customer balance for customer_id         // throws before the status change if it cannot
   END IF
 
   SET user status = "CLOSED"
   SAVE user to database
+  REVOKE sessions of customer_id
 END
 
 
@@ -962,15 +3739,16 @@ Input: email (string), phone (string)
 Output: blacklisted (boolean)
 
 BEGIN
-  CHECK if email exists in blacklist
-  IF email exists THEN
-    RETURN TRUE
-  END IF
-
-  CHECK if phone exists in blacklist
-  IF phone exists THEN
-    RETURN TRUE
-  END IF
+  // Answered from the in-memory blacklist index; negatives never reach the database
+  FOR EACH key IN ["email:" + normalize email, "phone:" + normalize phone] DO
+    IF blacklist bloom filter might not contain key THEN
+      INCREMENT bloom negatives by 1
+    ELSE IF key is in blacklist key set THEN
+      RETURN TRUE
+    ELSE
+      INCREMENT bloom false positives by 1
+    END IF
+  END FOR
 
   RETURN FALSE
 END
@@ -981,12 +3759,156 @@ Input: email (string), phone (string)
 Output: none
 
 BEGIN
-  CHECK if email OR phone already exists in blacklist
-  IF not exists THEN
+  SET email_key = "email:" + normalize email
+  SET phone_key = "phone:" + normalize phone
+
+  IF email_key is not in blacklist key set AND phone_key is not in blacklist key set THEN
     CREATE new blacklist entry
-    SET entry email = email
-    SET entry phone = phone
+    SET entry email = normalized email
+    SET entry phone = normalized phone
     SET entry created_at = current timestamp
     SAVE entry to database
   END IF
+
+  ADD keys email_key, phone_key to blacklist index
+  // Other processes never ask the database on a negative, so they must hear about it
+  PUBLISH blacklist keys (email_key, phone_key) to the other application processes
+END
+
+
+Function: add_keys_to_blacklist_index
+Input: keys (list of string)
+Output: none
+
+BEGIN
+  // Used for local additions and for additions published by other processes
+  ACQUIRE blacklist index lock
+  IF blacklist pending_keys is set THEN
+    ADD keys to blacklist pending_keys               // a load is in progress; re-applied after its swap
+  END IF
+  FOR EACH key IN keys DO                            // current structures too, so lookups see it now
+    IF key is not in blacklist key set THEN
+      ADD key to blacklist key set
+      ADD key to blacklist bloom filter
+    END IF
+  END FOR
+  RELEASE blacklist index lock
+END
+
+
+Function: normalize_email
+Input: email (string)
+Output: normalized email (string)
+
+BEGIN
+  TRIM whitespace from email
+  RETURN email case-folded
+END
+
+
+Function: normalize_phone
+Input: phone (string)
+Output: normalized phone (string)
+
+BEGIN
+  SET digits = phone with every character that is not a digit removed
+  IF phone starts with "+" THEN
+    RETURN "+" + digits
+  END IF
+  IF digits starts with "00" THEN
+    RETURN "+" + digits without the leading "00"
+  END IF
+  RETURN "+" + DEFAULT_COUNTRY_CODE + digits without leading zeros      // E.164
+END
+
+
+Function: load_blacklist_index
+Input: none
+Output: none
+
+BEGIN
+  // Subscribe first so additions published while loading are not missed. Until the new
+  // structures are swapped in, published keys are held back rather than added to the old ones
+  ACQUIRE blacklist index lock
+  SET blacklist pending_keys = empty set
+  RELEASE blacklist index lock
+  IF this process is not subscribed to blacklist keys THEN
+    SUBSCRIBE to published blacklist keys, adding each to the blacklist index
+  END IF
+  FETCH all blacklist entries
+  SET n = max(2 × number of keys in entries, BLACKLIST_MIN_CAPACITY)    // headroom for additions
+  SET p = BLACKLIST_TARGET_FP_RATE
+
+  // Standard Bloom sizing: m bits and k hash functions for n keys at false-positive rate p
+  SET m = ceiling(-n × ln(p) / (ln 2)^2)
+  SET k = max(1, round(m / n × ln 2))
+  CREATE new bloom filter as a bit array of m bits with k hash functions
+  CREATE new empty key set
+
+  FOR EACH entry IN blacklist entries DO
+    FOR EACH key IN ["email:" + normalize entry email, "phone:" + normalize entry phone] DO
+      ADD key to new key set
+      ADD key to new bloom filter
+    END FOR
+  END FOR
+
+  ACQUIRE blacklist index lock
+  REPLACE blacklist bloom filter with the new bloom filter
+  REPLACE blacklist key set with the new key set
+  SET pending = blacklist pending_keys
+  SET blacklist pending_keys = NULL                     // later keys go straight to the index
+  FOR EACH key IN pending DO                            // added or published while loading
+    IF key is not in blacklist key set THEN
+      ADD key to blacklist key set
+      ADD key to blacklist bloom filter
+    END IF
+  END FOR
+  RELEASE blacklist index lock
+END
+
+
+Function: bloom_add
+Input: key (string)
+Output: none
+
+BEGIN
+  SET h1, h2 = two 64-bit halves of a 128-bit hash of key
+  FOR i FROM 0 TO k - 1 DO
+    SET bit (h1 + i × h2) mod m in the bloom filter         // double hashing
+  END FOR
+  INCREMENT bloom filter key_count by 1
+END
+
+
+Function: bloom_might_contain
+Input: key (string)
+Output: maybe (boolean)
+
+BEGIN
+  SET h1, h2 = two 64-bit halves of a 128-bit hash of key
+  FOR i FROM 0 TO k - 1 DO
+    IF bit (h1 + i × h2) mod m in the bloom filter is not set THEN
+      RETURN FALSE
+    END IF
+  END FOR
+  RETURN TRUE
+END
+
+
+Function: get_blacklist_index_stats
+Input: none
+Output: key_count (integer), expected_fp_rate (decimal), observed_fp_rate (decimal), memory_bytes (integer)
+
+BEGIN
+  SET key_count = bloom filter key_count
+  SET expected_fp_rate = (1 - e ^ (-k × key_count / m)) ^ k
+  // Observed: Bloom positives that the exact set then rejected, over all negative lookups
+  SET negative_lookups = bloom false positives + bloom negatives
+  IF negative_lookups = 0 THEN
+    SET observed_fp_rate = 0                   // no lookups yet
+  ELSE
+    SET observed_fp_rate = bloom false positives / negative_lookups
+  END IF
+  SET memory_bytes = m / 8 + memory used by blacklist key set
+  RETURN key_count, expected_fp_rate, observed_fp_rate, memory_bytes
 END